@@ -0,0 +1,108 @@
+import gzip
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def _day(message):
+    """Дата сообщения YYYY-MM-DD для выбора файла архива"""
+    timestamp = message.get('timestamp')
+    if isinstance(timestamp, str) and len(timestamp) >= 10 and timestamp[4] == '-' and timestamp[7] == '-':
+        return timestamp[:10]
+    return 'undated'
+
+
+class MessageArchive:
+    """Архив старых сообщений: по файлу на день, JSON lines в gzip
+
+    Файлы лежат как <каталог>/YYYY-MM/YYYY-MM-DD.jsonl.gz, строка - запись
+    {"user_id": ..., "message": {...}} в формате stored_messages.json.
+    Дозапись добавляет к файлу новый gzip-поток, gzip читает такие файлы
+    целиком. Поиск читает файлы потоково, от новых дней к старым, и ничего
+    не загружает в память хранилища.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, day):
+        return os.path.join(self.directory, day[:7] if day != 'undated' else day, f"{day}.jsonl.gz")
+
+    def append(self, user_id, messages):
+        """Дописывает сообщения пользователя в архив; возвращает число записанных"""
+        by_day = {}
+        for message in messages:
+            record = json.dumps({'user_id': user_id, 'message': message}, ensure_ascii=False, separators=(',', ':'))
+            by_day.setdefault(_day(message), []).append(record + '\n')
+
+        for day, lines in by_day.items():
+            path = self._path(day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+                    f.write(''.join(lines).encode('utf-8'))
+                raw.flush()
+                os.fsync(raw.fileno())
+        return len(messages)
+
+    def days(self):
+        """Дни, за которые есть архив, от новых к старым"""
+        days = []
+        if not os.path.isdir(self.directory):
+            return days
+        for folder in os.listdir(self.directory):
+            folder_path = os.path.join(self.directory, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            for name in os.listdir(folder_path):
+                if name.endswith('.jsonl.gz'):
+                    days.append(name[:-len('.jsonl.gz')])
+        return sorted(days, reverse=True)
+
+    def query(self, user_id=None, username=None, since=None, until=None, limit=20):
+        """Ищет сообщения в архиве, самые новые первыми
+
+        since и until - даты YYYY-MM-DD включительно; username без @.
+        """
+        found = []
+        for day in self.days():
+            if until and day != 'undated' and day > until:
+                continue
+            if since and (day == 'undated' or day < since):
+                continue
+            matches = []
+            try:
+                with gzip.open(self._path(day), 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        message = record['message']
+                        if user_id is not None and record['user_id'] != str(user_id):
+                            continue
+                        if username is not None and (message.get('username') or '').lower() != username.lower():
+                            continue
+                        matches.append((record['user_id'], message))
+            except (OSError, EOFError) as e:
+                # Оборванный при записи поток gzip: берем то, что успели прочитать
+                logger.warning(f"Архив за {day} прочитан не полностью: {e}")
+            matches.sort(key=lambda item: str(item[1].get('timestamp', '')), reverse=True)
+            found.extend(matches[:limit - len(found)])
+            if len(found) >= limit:
+                break
+        return found
+
+    def stats(self):
+        """Число файлов, их размер на диске и диапазон дат"""
+        days = self.days()
+        size = sum(os.path.getsize(self._path(day)) for day in days)
+        dated = [day for day in days if day != 'undated']
+        return {
+            'files': len(days),
+            'bytes': size,
+            'first': dated[-1] if dated else None,
+            'last': dated[0] if dated else None,
+        }
@@ -0,0 +1,456 @@
+"""Замеры производительности хранилища и админ-панели
+
+    python bench.py memory --messages 100000 --users 1000
+    python bench.py suite --sizes small medium --output before.json
+    python bench.py webhook --requests 2000
+
+suite гоняет пути бота на синтетических данных без сети: вместо Telegram -
+FakeBot в процессе. Результат - JSON с ревизией git, его можно сравнивать
+между версиями. webhook поднимает WebhookServer на случайном порту и шлет
+ему запросы как Telegram: сначала проверки ответов (неверный токен, обычное
+обновление, оборванное тело), затем поток обновлений по одному соединению.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from storage import UserMessages
+
+# Размеры синтетического ящика: (сообщений, пользователей)
+SIZES = {
+    'small': (1000, 10),
+    'medium': (100000, 10000),
+    'large': (1000000, 100000),
+}
+
+
+def synthetic_messages(messages, users, start=datetime(2024, 1, 1)):
+    """Сообщения в формате stored_messages.json, по кругу от users пользователей"""
+    for i in range(messages):
+        user = i % users
+        yield str(user), {
+            'timestamp': (start + timedelta(seconds=i, microseconds=i % 1000000)).isoformat(),
+            'type': 'text',
+            'content': f"Анонимный вопрос номер {i}",
+            'full_name': f"Пользователь {user}",
+            'username': f"user{user}",
+            'viewed': i % 3 == 0,
+        }
+
+
+def _measure(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def bench_memory(messages, users):
+    """Память под сообщения: словарь на сообщение против UserMessages"""
+    # Строки в журнале, как их читает JournalMessageStore при загрузке
+    lines = [json.dumps(message, ensure_ascii=False) for _, message in synthetic_messages(messages, users)]
+    user_ids = [str(i % users) for i in range(messages)]
+
+    def build_dicts():
+        store = {}
+        for user_id, line in zip(user_ids, lines):
+            store.setdefault(user_id, []).append(json.loads(line))
+        return store
+
+    def build_columns():
+        store = {}
+        for user_id, line in zip(user_ids, lines):
+            store.setdefault(user_id, UserMessages()).append(json.loads(line))
+        return store
+
+    dict_bytes, dicts = _measure(build_dicts)
+    del dicts
+    column_bytes, columns = _measure(build_columns)
+    del columns
+    return {
+        'messages': messages,
+        'users': users,
+        'dict_bytes': dict_bytes,
+        'column_bytes': column_bytes,
+        'dict_bytes_per_message': round(dict_bytes / messages, 1),
+        'column_bytes_per_message': round(column_bytes / messages, 1),
+        'saving': round(1 - column_bytes / dict_bytes, 3),
+    }
+
+
+class FakeMessage:
+    """Ответ бота: из него обработчикам нужны только идентификаторы"""
+
+    def __init__(self, chat_id, message_id):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.animation = None
+        self.document = None
+
+
+class FakeBot:
+    """Бот без сети: методы Bot API сразу возвращают результат и считаются"""
+
+    username = 'bench_bot'
+
+    def __init__(self):
+        self.calls = {}
+        self._next_id = 0
+
+    def _call(self, method, chat_id):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self._next_id += 1
+        return FakeMessage(chat_id, self._next_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return self._call('send_message', chat_id)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        return self._call('copy_message', chat_id)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        self._call('delete_message', chat_id)
+        return True
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        self._call('delete_messages', chat_id)
+        return True
+
+
+class FakeQuery:
+    """Нажатие кнопки админ-панели; запоминает последний показанный экран"""
+
+    def __init__(self, data):
+        self.data = data
+        self.screen = None
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        self.screen = (text, reply_markup)
+
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+        self.bot_data = {'CHANNEL_ID': -100, 'OWNER_ID': 1, 'message_count': 0}
+        self.job_queue = None
+
+
+def _click(data):
+    """Обновление с нажатием кнопки владельцем"""
+    query = FakeQuery(data)
+    owner = type('User', (), {'id': 1})()
+    return type('Update', (), {'callback_query': query, 'effective_user': owner})(), query
+
+
+def _seconds(samples):
+    return {'median': round(statistics.median(samples), 6), 'min': round(min(samples), 6), 'runs': len(samples)}
+
+
+def _repeat(fn, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return _seconds(samples)
+
+
+async def _repeat_async(make_coro, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await make_coro()
+        samples.append(time.perf_counter() - start)
+    return _seconds(samples)
+
+
+def _revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_storage(main, messages, users, runs):
+    """Заполнение, загрузка (load_messages) и сброс на диск (save_messages)"""
+    result = {}
+    store = main.load_messages()
+    start = time.perf_counter()
+    for user_id, message in synthetic_messages(messages, users):
+        store.add_message(user_id, message)
+    store.flush()
+    result['populate_seconds'] = round(time.perf_counter() - start, 6)
+    store.close()
+
+    def load():
+        main.message_store = main.load_messages()
+
+    # Каждая загрузка, кроме последней, сразу закрывается
+    samples = []
+    for i in range(runs):
+        start = time.perf_counter()
+        load()
+        samples.append(time.perf_counter() - start)
+        if i < runs - 1:
+            main.message_store.close()
+    result['load_messages'] = _seconds(samples)
+
+    # save_messages после пачки новых сообщений
+    batch = min(1000, messages)
+    samples = []
+    for _ in range(runs):
+        for user_id, message in synthetic_messages(batch, users, start=datetime(2025, 1, 1)):
+            main.message_store.add_message(user_id, message)
+        start = time.perf_counter()
+        main.save_messages()
+        samples.append(time.perf_counter() - start)
+    result['save_messages_after_batch'] = {**_seconds(samples), 'batch': batch}
+    return result
+
+
+async def bench_admin(main, runs):
+    """Счетчики админ-панели и экраны просмотра сообщений - без кэша и из кэша"""
+    from render import RenderCache
+
+    result = {}
+    bot = FakeBot()
+    context = FakeContext(bot)
+    busiest = main.message_store.users_page(None, 1)[0][0]['user_id']
+
+    for mode, cache_size in (('cold', 0), ('warm', main.RENDER_CACHE_SIZE)):
+        main.RENDER_CACHE = RenderCache(max_entries=cache_size)
+        section = result[mode] = {}
+        section['admin_counts'] = _repeat(main.message_store.counts, runs)
+        section['render_admin_panel'] = _repeat(main.render_admin_panel, runs)
+
+        async def first_users_page():
+            await main.view_accumulated_messages(_click('view_messages')[0], context)
+        section['view_accumulated_messages'] = await _repeat_async(first_users_page, runs)
+
+        async def walk_users_pages(pages=10):
+            data = 'view_messages'
+            for _ in range(pages):
+                update, query = _click(data)
+                await main.view_accumulated_messages(update, context)
+                buttons = [button.callback_data for row in query.screen[1].inline_keyboard for button in row]
+                following = [b for b in buttons if b.startswith('users_page_')]
+                if not following:
+                    break
+                data = following[-1]
+        section['view_accumulated_messages_10_pages'] = await _repeat_async(walk_users_pages, runs)
+
+        async def user_first_page():
+            await main.view_user_messages(_click(f'user_msgs_{busiest}')[0], context)
+        section['view_user_messages'] = await _repeat_async(user_first_page, runs)
+
+        total = main.message_store.user_counts(busiest)[0]
+        deep = max(0, (total - 1) // main.MESSAGES_PAGE_SIZE * main.MESSAGES_PAGE_SIZE)
+
+        async def user_last_page():
+            await main.view_user_messages(_click(f'user_page_{busiest}_{deep}')[0], context)
+        section['view_user_messages_last_page'] = {**await _repeat_async(user_last_page, runs), 'offset': deep}
+    return result
+
+
+async def bench_auto_delete(main, pending, runs):
+    """Тик автоудаления при большой очереди SENT_MESSAGES
+
+    Лимиты Telegram на чат в замере сняты: меряется работа бота, а не паузы ведра токенов.
+    """
+    from deletion import DeletionScheduler
+
+    bot = FakeBot()
+    context = FakeContext(bot)
+    expired = max(1, pending // 10)
+    result = {'pending': pending, 'expired_per_tick': expired}
+
+    def fill():
+        main.SENT_MESSAGES = DeletionScheduler(
+            concurrency=main.DELETE_CONCURRENCY, chat_rate=1e9, chat_burst=1e9
+        )
+        for i in range(pending):
+            chat_id = -100 if i % 2 else i % 1000 + 1
+            main.SENT_MESSAGES.schedule(chat_id, i, -1 if i < expired else main.AUTO_DELETE_AFTER)
+
+    result['schedule'] = _repeat(fill, 1)
+
+    samples = []
+    for _ in range(runs):
+        fill()
+        start = time.perf_counter()
+        await main.auto_delete_messages(context)
+        samples.append(time.perf_counter() - start)
+    result['tick_with_expired'] = _seconds(samples)
+    result['tick_idle'] = await _repeat_async(lambda: main.auto_delete_messages(context), runs)
+    result['bot_calls'] = bot.calls
+    return result
+
+
+class FakeApplication:
+    """То, что WebhookServer берет у Application: бот, признак работы и очередь"""
+
+    def __init__(self):
+        self.bot = None
+        self.running = True
+        self.update_queue = asyncio.Queue()
+
+
+WEBHOOK_PATH = '/hook'
+WEBHOOK_SECRET = 'bench-secret'
+
+
+def _webhook_request(update_id, token=WEBHOOK_SECRET, length=None):
+    body = json.dumps({
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'вопрос'},
+    }).encode('utf-8')
+    head = (
+        f"POST {WEBHOOK_PATH} HTTP/1.1\r\n"
+        "Host: 127.0.0.1\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body) if length is None else length}\r\n"
+        f"X-Telegram-Bot-Api-Secret-Token: {token}\r\n\r\n"
+    )
+    return head.encode('latin-1') + body
+
+
+async def _webhook_status(reader, writer, request):
+    writer.write(request)
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1])
+
+
+async def bench_webhook(requests):
+    """Вебхук против локального клиента вместо Telegram"""
+    from webhook import WebhookServer
+
+    loop = asyncio.get_running_loop()
+    unhandled = []
+    loop.set_exception_handler(lambda loop, context: unhandled.append(context.get('message')))
+    application = FakeApplication()
+    server = WebhookServer(application, port=0, url_path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    await server.start()
+    checks = {}
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.bound_port)
+        checks['wrong_token_403'] = await _webhook_status(reader, writer, _webhook_request(1, token='wrong')) == 403
+        checks['update_200'] = (
+            await _webhook_status(reader, writer, _webhook_request(2)) == 200
+            and (await application.update_queue.get()).update_id == 2
+        )
+
+        # Тело короче заявленного Content-Length, после чего клиент закрывает соединение
+        short_reader, short_writer = await asyncio.open_connection('127.0.0.1', server.bound_port)
+        short_writer.write(_webhook_request(3, length=100)[:-50])
+        await short_writer.drain()
+        short_writer.close()
+        await asyncio.sleep(0.1)
+        checks['truncated_body_closed'] = not unhandled and application.update_queue.empty()
+
+        start = time.perf_counter()
+        for update_id in range(requests):
+            writer.write(_webhook_request(update_id))
+        await writer.drain()
+        for _ in range(requests):
+            await reader.readuntil(b'\r\n\r\n')
+        seconds = time.perf_counter() - start
+        writer.close()
+    finally:
+        await server.stop()
+    return {
+        'checks': checks,
+        'ok': all(checks.values()),
+        'requests': requests,
+        'received': server.received,
+        'seconds': round(seconds, 6),
+        'per_second': round(requests / seconds) if seconds else None,
+    }
+
+
+def bench_suite(sizes, backend, runs):
+    """Все замеры для каждого размера в отдельном временном каталоге"""
+    import main
+
+    logging.disable(logging.WARNING)
+    main.STORAGE_BACKEND = backend
+    cwd = os.getcwd()
+    report = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'backend': backend,
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'results': [],
+    }
+    try:
+        for name in sizes:
+            messages, users = SIZES[name]
+            with tempfile.TemporaryDirectory(prefix='botg-bench-') as workdir:
+                os.chdir(workdir)
+                entry = {'size': name, 'messages': messages, 'users': users}
+                entry['storage'] = bench_storage(main, messages, users, runs)
+                entry['admin'] = asyncio.run(bench_admin(main, runs))
+                entry['auto_delete'] = asyncio.run(bench_auto_delete(main, messages, runs))
+                main.message_store.close()
+                main.message_store = None
+                os.chdir(cwd)
+            report['results'].append(entry)
+    finally:
+        os.chdir(cwd)
+        logging.disable(logging.NOTSET)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='bench', required=True)
+    memory = sub.add_parser('memory', help="память под сообщения в JournalMessageStore")
+    memory.add_argument('--messages', type=int, default=100000)
+    memory.add_argument('--users', type=int, default=1000)
+    suite = sub.add_parser('suite', help="загрузка и сохранение, админ-панель, автоудаление")
+    suite.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=['small', 'medium'])
+    suite.add_argument('--backend', choices=['journal', 'sqlite'], default='journal')
+    suite.add_argument('--runs', type=int, default=5)
+    suite.add_argument('--output', help="файл для JSON (по умолчанию - вывод в консоль)")
+    webhook = sub.add_parser('webhook', help="проверка и пропускная способность встроенного вебхука")
+    webhook.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.bench == 'memory':
+        result = bench_memory(args.messages, args.users)
+    elif args.bench == 'suite':
+        result = bench_suite(args.sizes, args.backend, args.runs)
+    elif args.bench == 'webhook':
+        logging.basicConfig(level=logging.ERROR)
+        result = asyncio.run(bench_webhook(args.requests))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if getattr(args, 'output', None):
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if result.get('ok') is False:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
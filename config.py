@@ -2,3 +2,16 @@ BOT_TOKEN = "7712687330:AAHvPfuvCYgww0Bm3F_eUtIvzR1cmmw1OOI"
 CHANNEL_ID = "@senjyz" 
 
 OWNER_ID = 7920265577
+
+# Получение обновлений: "polling" (getUpdates) или "webhook"
+UPDATE_MODE = "polling"
+# Для вебхука: публичный https-адрес, который Telegram будет вызывать
+WEBHOOK_URL = ""
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET_TOKEN = ""  # 1-256 символов A-Z, a-z, 0-9, _ и -
+# Сертификат и ключ, если TLS завершается в самом боте (а не в прокси перед ним)
+WEBHOOK_CERT = ""
+WEBHOOK_KEY = ""
+WEBHOOK_MAX_CONNECTIONS = 40  # одновременных соединений со стороны Telegram (1-100)
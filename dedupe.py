@@ -0,0 +1,93 @@
+import logging
+import time
+from collections import OrderedDict
+
+from storage import AppendLog, _done_future
+
+logger = logging.getLogger(__name__)
+
+
+class Deduplicator:
+    """Ключи уже обработанных обновлений со сроком жизни и ограничением размера
+
+    Ключ - update_id или хэш содержимого сообщения. claim() атомарно (в
+    цикле событий) проверяет и занимает ключ, поэтому повторная доставка
+    обновления или двойное нажатие "отправить" не приводят ко второму посту.
+    Время - по часам (time.time()), чтобы срок пережил перезапуск; ключи
+    пишутся в текстовый журнал строками "+<TAB>ключ<TAB>срок" и "-<TAB>ключ".
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.duplicates = 0
+        self._keys = OrderedDict()  # ключ -> срок; порядок - по времени занятия
+        self._log = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def open(self, path, **writer_options):
+        """Загружает ключи, срок которых не истек, и начинает их записывать"""
+        now = time.time()
+        for line in AppendLog.read(path):
+            parts = line.split('\t')
+            try:
+                if parts[0] == '+' and len(parts) == 3 and float(parts[2]) > now:
+                    self._keys[parts[1]] = float(parts[2])
+                    self._keys.move_to_end(parts[1])
+                elif parts[0] == '-' and len(parts) == 2:
+                    self._keys.pop(parts[1], None)
+            except ValueError:
+                logger.warning(f"Пропущена поврежденная строка {path}: {line!r}")
+        self._evict(now)
+
+        self._log = AppendLog(path, **writer_options)
+        self._snapshot()
+        logger.info(f"Ключи дедупликации загружены: {len(self._keys)}")
+
+    def _snapshot(self):
+        self._log.snapshot([f"+\t{key}\t{expires:.0f}" for key, expires in self._keys.items()])
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+
+    def _evict(self, now):
+        """Вытесняет самые старые ключи: истекшие и сверх max_entries"""
+        keys = self._keys
+        while keys:
+            key, expires = next(iter(keys.items()))
+            if expires > now and len(keys) <= self.max_entries:
+                break
+            keys.popitem(last=False)
+
+    def seen(self, key):
+        """Ключ уже занят и его срок не истек (такая проверка считается повтором)"""
+        expires = self._keys.get(key)
+        if expires is None:
+            return False
+        if expires > time.time():
+            self.duplicates += 1
+            return True
+        del self._keys[key]
+        return False
+
+    def claim(self, key, ttl):
+        """Занимает ключ на ttl секунд; None, если он уже занят, иначе Future записи на диск"""
+        if self.seen(key):
+            return None
+        now = time.time()
+        self._keys[key] = now + ttl
+        self._evict(now)
+        if not self._log:
+            return _done_future()
+        written = self._log.append(f"+\t{key}\t{now + ttl:.0f}")
+        if self._log.records > 2 * len(self._keys) + 1000:
+            self._snapshot()
+        return written
+
+    def release(self, key):
+        """Освобождает ключ, если обработка не удалась и повтор должен пройти"""
+        if self._keys.pop(key, None) is not None and self._log:
+            self._log.append(f"-\t{key}")
@@ -0,0 +1,253 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from ratelimit import TokenBucket, retry_after_seconds
+from storage import AppendLog
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых повторять удаление бессмысленно
+PERMANENT_ERRORS = (
+    "message to delete not found",
+    "message can't be deleted",
+    "message identifier is not specified",
+    "chat not found",
+)
+
+# deleteMessages принимает не больше 100 идентификаторов за раз
+BULK_DELETE_LIMIT = 100
+
+
+class PendingDeletion:
+    """Сообщение, ожидающее удаления"""
+
+    __slots__ = ('chat_id', 'message_id', 'deadline', 'attempts')
+
+    def __init__(self, chat_id, message_id, deadline, attempts=0):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.deadline = deadline
+        self.attempts = attempts
+
+
+def is_permanent_error(error):
+    """Ошибка, которую не исправит повторная попытка"""
+    if isinstance(error, Forbidden):
+        return True
+    if isinstance(error, BadRequest):
+        text = str(error).lower()
+        return any(marker in text for marker in PERMANENT_ERRORS)
+    return False
+
+
+def _parse_chat_id(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+class DeletionScheduler:
+    """Очередь удаления сообщений, упорядоченная по сроку (куча)
+
+    За тик извлекаются только просроченные записи, поэтому стоимость тика
+    зависит от числа удаляемых сообщений, а не от размера очереди.
+    Удаление идет пачками через deleteMessages, параллельно (не больше
+    concurrency запросов) и с ведром токенов на каждый чат.
+
+    После open() очередь пишется в текстовый журнал строками
+    "+<TAB>срок<TAB>попыток<TAB>чат<TAB>сообщение" и "-<TAB>чат<TAB>сообщение",
+    чтобы после перезапуска посты все равно были удалены.
+    """
+
+    def __init__(self, max_attempts=5, base_backoff=30, max_backoff=1800,
+                 concurrency=4, chat_rate=3, chat_burst=5):
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.concurrency = concurrency
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.last_run = {'deleted': 0, 'requests': 0, 'seconds': 0.0}
+        self._heap = []
+        self._order = itertools.count()
+        self._buckets = {}
+        self._log = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    # Журнал на диске
+
+    def open(self, path, **writer_options):
+        """Загружает сохраненную очередь и начинает записывать изменения; возвращает число просроченных"""
+        pending = {}
+        for line in AppendLog.read(path):
+            parts = line.split('\t')
+            try:
+                if parts[0] == '+' and len(parts) == 5:
+                    pending[(parts[3], parts[4])] = (float(parts[1]), int(parts[2]))
+                elif parts[0] == '-' and len(parts) == 3:
+                    pending.pop((parts[1], parts[2]), None)
+            except ValueError:
+                logger.warning(f"Пропущена поврежденная строка {path}: {line!r}")
+
+        for (chat_id, message_id), (deadline, attempts) in pending.items():
+            self._heap.append((deadline, next(self._order), PendingDeletion(
+                _parse_chat_id(chat_id), int(message_id), deadline, attempts
+            )))
+        heapq.heapify(self._heap)
+
+        self._log = AppendLog(path, **writer_options)
+        self._snapshot()
+
+        now = time.time()
+        overdue = sum(1 for deadline, _, _ in self._heap if deadline <= now)
+        logger.info(f"Очередь автоудаления загружена: {len(self._heap)} сообщений, просрочено {overdue}")
+        return overdue
+
+    def _snapshot(self):
+        """Ставит в очередь записи полное состояние вместо накопившегося журнала"""
+        self._log.snapshot([self._added_line(entry) for _, _, entry in self._heap])
+
+    @staticmethod
+    def _added_line(entry):
+        return f"+\t{entry.deadline:.0f}\t{entry.attempts}\t{entry.chat_id}\t{entry.message_id}"
+
+    def _log_added(self, entry):
+        if self._log:
+            self._log.append(self._added_line(entry))
+
+    def _log_done(self, entry):
+        if self._log:
+            self._log.append(f"-\t{entry.chat_id}\t{entry.message_id}")
+
+    def close(self):
+        """Дописывает журнал на диск"""
+        if self._log:
+            self._log.close()
+            self._log = None
+
+    # Очередь
+
+    def _push(self, entry):
+        heapq.heappush(self._heap, (entry.deadline, next(self._order), entry))
+
+    def schedule(self, chat_id, message_id, delay):
+        """Планирует удаление сообщения через delay секунд"""
+        entry = PendingDeletion(chat_id, message_id, time.time() + delay)
+        self._push(entry)
+        self._log_added(entry)
+
+    def pop_expired(self, now=None):
+        """Извлекает все записи, срок которых наступил"""
+        now = time.time() if now is None else now
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expired.append(heapq.heappop(self._heap)[2])
+        return expired
+
+    def failed(self, entry, error):
+        """Обрабатывает неудачное удаление: повтор с нарастающей паузой или отказ"""
+        if is_permanent_error(error):
+            logger.info(f"Сообщение {entry.message_id} уже не удалить ({error}), убрано из очереди")
+            self._log_done(entry)
+            return False
+
+        entry.attempts += 1
+        if entry.attempts >= self.max_attempts:
+            logger.error(f"Сообщение {entry.message_id} не удалено за {entry.attempts} попыток: {error}")
+            self._log_done(entry)
+            return False
+
+        if isinstance(error, RetryAfter):
+            delay = retry_after_seconds(error)
+        else:
+            delay = min(self.base_backoff * 2 ** (entry.attempts - 1), self.max_backoff)
+        entry.deadline = time.time() + delay
+        self._push(entry)
+        self._log_added(entry)
+        logger.warning(f"Ошибка удаления {entry.message_id}: {error}, повтор через {delay:.0f} с")
+        return True
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _delete_one(self, bot, entry):
+        await self._bucket(entry.chat_id).acquire()
+        self.last_run['requests'] += 1
+        try:
+            await bot.delete_message(chat_id=entry.chat_id, message_id=entry.message_id)
+            self._log_done(entry)
+            return 1
+        except Exception as e:
+            self.failed(entry, e)
+            return 0
+
+    async def _delete_batch(self, bot, chat_id, entries, semaphore):
+        async with semaphore:
+            if len(entries) == 1:
+                return await self._delete_one(bot, entries[0])
+
+            await self._bucket(chat_id).acquire()
+            self.last_run['requests'] += 1
+            try:
+                # Ненайденные сообщения deleteMessages просто пропускает
+                await bot.delete_messages(chat_id=chat_id, message_ids=[entry.message_id for entry in entries])
+                for entry in entries:
+                    self._log_done(entry)
+                return len(entries)
+            except BadRequest as e:
+                # Пачку целиком отклонили (например, среди сообщений есть старше 48 часов) -
+                # удаляем по одному, чтобы разобрать ошибки по каждому сообщению
+                logger.warning(f"Пачечное удаление в {chat_id} отклонено ({e}), удаление по одному")
+                deleted = 0
+                for entry in entries:
+                    deleted += await self._delete_one(bot, entry)
+                return deleted
+            except Exception as e:
+                for entry in entries:
+                    self.failed(entry, e)
+                return 0
+
+    async def _take_expired(self):
+        """Просроченные записи для run(); куча в памяти разбирается сразу"""
+        return self.pop_expired()
+
+    async def run(self, bot):
+        """Удаляет все просроченные сообщения; возвращает число удаленных"""
+        expired = await self._take_expired()
+        self.last_run = {'deleted': 0, 'requests': 0, 'seconds': 0.0}
+        if not expired:
+            return 0
+
+        started = time.monotonic()
+        by_chat = {}
+        for entry in expired:
+            by_chat.setdefault(entry.chat_id, []).append(entry)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [
+            self._delete_batch(bot, chat_id, entries[i:i + BULK_DELETE_LIMIT], semaphore)
+            for chat_id, entries in by_chat.items()
+            for i in range(0, len(entries), BULK_DELETE_LIMIT)
+        ]
+        deleted = sum(await asyncio.gather(*tasks))
+
+        self.last_run['deleted'] = deleted
+        self.last_run['seconds'] = time.monotonic() - started
+        if self._log and self._log.records > 2 * len(self._heap) + 1000:
+            self._snapshot()
+        logger.info(
+            f"Автоудаление: удалено {deleted} из {len(expired)} сообщений, "
+            f"{self.last_run['requests']} запросов за {self.last_run['seconds']:.2f} с"
+        )
+        return deleted
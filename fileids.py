@@ -0,0 +1,58 @@
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def source_hash(source):
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+class FileIdCache:
+    """file_id файлов, уже загруженных в Telegram, по имени настройки
+
+    Вместе с file_id хранится хэш источника (URL из файла настроек): если
+    настройка изменилась, хэш не совпадет и файл загрузится заново. На
+    каждое имя хранится одна запись, поэтому файл кэша не растет. Файл
+    перезаписывается целиком через временный - запись редкая.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}  # имя -> [хэш источника, file_id]
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            self._entries = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Кэш file_id {self.path} не прочитан, начинаем заново: {e}")
+            self._entries = {}
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def get(self, name, source):
+        """file_id для текущего источника или None"""
+        entry = self._entries.get(name)
+        if entry and entry[0] == source_hash(source):
+            return entry[1]
+        return None
+
+    def put(self, name, source, file_id):
+        self._entries[name] = [source_hash(source), file_id]
+        self._save()
+
+    def forget(self, name):
+        """file_id больше не принимается Telegram"""
+        if self._entries.pop(name, None) is not None:
+            self._save()
@@ -1,11 +1,14 @@
 import logging
 import asyncio
+import hashlib
 import os
-import json
 import secrets
 import re
-from datetime import datetime, timedelta
+import signal
+import time
+from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     MessageHandler,
@@ -15,6 +18,27 @@ from telegram.ext import (
     CallbackQueryHandler,
     CallbackContext
 )
+from archive import MessageArchive
+from dedupe import Deduplicator
+from deletion import DeletionScheduler
+from fileids import FileIdCache
+from metrics import InstrumentedRequest, Metrics, MetricsServer
+from notifier import OwnerNotifier
+from outbox import ChannelOutbox, length_error, telegram_length
+from ratelimit import UserRateLimiter
+from render import RenderCache
+from settings_cache import SettingsCache
+from resp import RespClient
+from shared import (
+    RedisMessageStore,
+    SharedDeduplicator,
+    SharedDeletionScheduler,
+    SharedOwnerNotifier,
+    SharedRateLimiter,
+    SharedSettings,
+)
+from storage import open_message_store
+from webhook import WebhookServer, make_ssl_context
 
 # Настройка логирования
 logging.basicConfig(
@@ -25,10 +49,121 @@ logger = logging.getLogger(__name__)
 
 # Константы
 DELETE_DELAY = 5
+AUTO_DELETE_AFTER = 25 * 60  # секунды, через которые пост удаляется из канала
+AUTO_DELETE_INTERVAL = 5  # как часто проверять очередь удаления (тик без просроченных почти бесплатен)
+DELETE_CONCURRENCY = 4  # параллельных запросов удаления
+DELETE_CHAT_RATE = 3  # запросов удаления в секунду на чат
+DELETE_CHAT_BURST = 5
+DELETION_QUEUE_FILE = "pending_deletions.log"
+WORKER_NAME = os.environ.get("BOT_WORKER", "")  # имя воркера, если их запущено несколько
+OUTBOX_FILE = f"outbox-{WORKER_NAME}.jsonl" if WORKER_NAME else "outbox.jsonl"
+DEDUPE_FILE = "processed_updates.log"
+UPDATE_DEDUPE_TTL = 24 * 60 * 60  # Telegram хранит недоставленные обновления сутки
+DEDUPE_MAX_ENTRIES = 100000
+CHANNEL_RATE = 20 / 60  # постов в секунду в канал
+CHANNEL_BURST = 3
+DIGEST_INTERVAL = 5 * 60  # как часто публикуется дайджест в режиме накопления
+NOTIFY_INTERVAL = 60  # не чаще одного уведомления владельцу за столько секунд
+WARNING_DELAY = 3
+CONCURRENT_UPDATES = 32  # сколько обновлений обрабатывается одновременно
+USERS_PAGE_SIZE = 10     # пользователей на странице просмотра
+MESSAGES_PAGE_SIZE = 10  # сообщений на странице просмотра
+RENDER_CACHE_SIZE = 1000  # сколько готовых экранов админ-панели держать в памяти
+# Срок хранения сообщений (None - без ограничения); все, что сверх, уходит в архив.
+# По умолчанию выключено, например: 180 * 24 * 60 * 60 секунд, 1000 на пользователя, 100000 всего
+RETENTION_MAX_AGE = None  # секунд
+RETENTION_PER_USER = None
+RETENTION_TOTAL = None
+ARCHIVE_DIR = "archive"
+ARCHIVE_INTERVAL = 60 * 60
+ARCHIVE_QUERY_LIMIT = 20
 SETTINGS_DIR = "Settings"
+SETTINGS_RELOAD_INTERVAL = 5  # как часто проверять, не изменились ли файлы настроек
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = int(os.environ.get("BOT_METRICS_PORT", 9108))  # 0 - эндпоинт /metrics выключен
+FILE_IDS_FILE = "file_ids.json"  # file_id приветственной анимации, уже загруженной в Telegram
 MESSAGES_FILE = "stored_messages.json"
-USER_LAST_MESSAGE = {}
-SENT_MESSAGES = []
+MESSAGES_JOURNAL = "stored_messages.jsonl"
+MESSAGES_DB = "stored_messages.db"
+STORAGE_BACKEND = "journal"  # "journal" или "sqlite"
+WRITE_QUEUE_SIZE = 10000
+WRITE_WINDOW = 0.2  # секунды, за которые записи собираются в одну группу
+WRITE_BATCH_SIZE = 500
+FSYNC_POLICY = "batch"  # "batch" - fsync после каждой группы, "none" - положиться на ОС
+# "local" - состояние в памяти и файлах процесса, "redis" - общее для нескольких воркеров
+STATE_BACKEND = "local"
+REDIS_URL = "redis://127.0.0.1:6379/0"
+STATE_PREFIX = "botg:"
+SHARED_SETTINGS = ('notify_owner', 'accumulate_mode')
+SHARED_SETTINGS_REFRESH = 1  # как часто перечитывать общие переключатели из Redis, секунды
+SPAM_BURST = 1  # сообщений подряд
+SPAM_INTERVAL = 10  # секунд на каждое следующее сообщение
+# Одинаковое сообщение от пользователя в течение стольких секунд - повтор. Не дольше
+# интервала антиспама: после него то же сообщение можно отправить снова
+CONTENT_DEDUPE_TTL = SPAM_INTERVAL
+SPAM_MAX_USERS = 100000
+SPAM_LIMITER = UserRateLimiter(burst=SPAM_BURST, interval=SPAM_INTERVAL, max_users=SPAM_MAX_USERS)
+SENT_MESSAGES = DeletionScheduler(
+    concurrency=DELETE_CONCURRENCY,
+    chat_rate=DELETE_CHAT_RATE,
+    chat_burst=DELETE_CHAT_BURST,
+)
+
+# Метрики: время обработчиков, вызовы Bot API, размеры очередей
+METRICS = Metrics()
+METRICS_SERVER = None
+
+# Сообщение пользователя нужно для copy_message, поэтому удаляется только после попытки публикации
+def delete_source(job):
+    if job.get('source'):
+        chat_id, message_id = job['source']
+        SENT_MESSAGES.schedule(chat_id, message_id, 0)
+
+# Пост доставлен в канал - планируем его автоудаление
+def on_channel_post(job, sent_message):
+    # send_media_group возвращает список сообщений альбома
+    sent = sent_message if isinstance(sent_message, (list, tuple)) else [sent_message]
+    for msg in sent:
+        SENT_MESSAGES.schedule(job['kwargs']['chat_id'], msg.message_id, AUTO_DELETE_AFTER)
+    delete_source(job)
+
+OWNER_NOTIFIER = OwnerNotifier()
+
+# Уже обработанные обновления и недавние сообщения: повтор не публикуется второй раз
+DEDUPE = Deduplicator(max_entries=DEDUPE_MAX_ENTRIES)
+
+# Готовые экраны админ-панели; сбрасываются при изменении сообщений пользователя
+RENDER_CACHE = RenderCache(max_entries=RENDER_CACHE_SIZE)
+
+ARCHIVE = MessageArchive(ARCHIVE_DIR)
+FILE_IDS = FileIdCache(FILE_IDS_FILE)
+
+def size_of(structure):
+    """Размер очереди или None, если реализация его не знает (например, общий антиспам)"""
+    return len(structure) if hasattr(structure, '__len__') else None
+
+def stat_of(structure, name):
+    """Значение из stats() или None, если реализация его не считает (память общего антиспама)"""
+    return structure.stats().get(name)
+
+METRICS.describe('handler_seconds', "Время обработки обновления или задачи")
+METRICS.describe('api_seconds', "Время вызова Bot API")
+METRICS.describe('api_flood_total', "Ответы 429 (флуд-контроль)")
+METRICS.gauge('pending_deletions', lambda: size_of(SENT_MESSAGES))
+METRICS.gauge('antispam_users', lambda: size_of(SPAM_LIMITER))
+METRICS.describe('antispam_rejected', "Сообщения, отклоненные антиспамом этого воркера с запуска")
+METRICS.describe('antispam_memory_bytes', "Примерная память под состояние антиспама")
+METRICS.gauge('antispam_allowed', lambda: stat_of(SPAM_LIMITER, 'allowed'))
+METRICS.gauge('antispam_rejected', lambda: stat_of(SPAM_LIMITER, 'rejected'))
+METRICS.gauge('antispam_evicted', lambda: stat_of(SPAM_LIMITER, 'evicted'))
+METRICS.gauge('antispam_memory_bytes', lambda: stat_of(SPAM_LIMITER, 'memory_bytes'))
+METRICS.gauge('outbox_pending', lambda: len(OUTBOX))
+METRICS.gauge('outbox_digest_buffered', lambda: OUTBOX.buffered())
+METRICS.gauge('dedupe_keys', lambda: size_of(DEDUPE))
+METRICS.gauge('render_cache_entries', lambda: len(RENDER_CACHE))
+OUTBOX = ChannelOutbox(
+    chat_rate=CHANNEL_RATE, chat_burst=CHANNEL_BURST, on_sent=on_channel_post, on_failed=delete_source
+)
 
 # Стандартные настройки
 DEFAULT_SETTINGS = {
@@ -69,57 +204,143 @@ def initialize_settings():
     except Exception as e:
         logger.error(f"Ошибка инициализации настроек: {e}")
 
-# Инициализация настроек при импорте
-initialize_settings()
+# Настройки из файлов перечитываются при изменении, без перезапуска бота
+SETTINGS = SettingsCache(
+    SETTINGS_DIR,
+    DEFAULT_SETTINGS,
+    files=('welcome_text', 'welcome_gif', 'channel_template', 'tagline'),
+    templates=('channel_template',),
+)
 
-# Функции для работы с файлами настроек
-def load_setting(setting_name):
-    """Загружает настройку из файла"""
+async def reload_settings(context: CallbackContext):
+    """Проверяет время изменения файлов настроек и подхватывает новые значения"""
     try:
-        file_path = os.path.join(SETTINGS_DIR, f"{setting_name}.txt")
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read().strip()
-        return DEFAULT_SETTINGS.get(setting_name, "")
+        await asyncio.to_thread(SETTINGS.check)
     except Exception as e:
-        logger.error(f"Ошибка загрузки {setting_name}: {e}")
-        return DEFAULT_SETTINGS.get(setting_name, "")
-
-def load_all_settings():
-    """Загружает все настройки из файлов"""
-    return {
-        'welcome_text': load_setting('welcome_text'),
-        'welcome_gif': load_setting('welcome_gif'),
-        'channel_template': load_setting('channel_template'),
-        'tagline': load_setting('tagline'),
-        'notify_owner': DEFAULT_SETTINGS['notify_owner'],
-        'accumulate_mode': DEFAULT_SETTINGS['accumulate_mode']
-    }
+        logger.error(f"Ошибка перечитывания настроек: {e}")
 
 # Загрузка сообщений
 def load_messages():
-    """Загружает сообщения из файла"""
-    try:
-        if os.path.exists(MESSAGES_FILE):
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
-    except Exception as e:
-        logger.error(f"Ошибка загрузки сообщений: {e}")
-        return {}
+    """Открывает хранилище сообщений (старый JSON импортируется в журнал один раз)"""
+    path = MESSAGES_DB if STORAGE_BACKEND == 'sqlite' else MESSAGES_JOURNAL
+    return open_message_store(
+        STORAGE_BACKEND,
+        path,
+        legacy_path=MESSAGES_FILE,
+        maxsize=WRITE_QUEUE_SIZE,
+        window=WRITE_WINDOW,
+        max_batch=WRITE_BATCH_SIZE,
+        fsync=FSYNC_POLICY,
+    )
 
 def save_messages():
-    """Сохраняет сообщения в файл"""
+    """Сбрасывает хранилище сообщений на диск"""
     try:
-        with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(stored_messages, f, indent=4, default=str)
-        logger.info("Сообщения сохранены")
+        message_store.flush()
     except Exception as e:
         logger.error(f"Ошибка сохранения сообщений: {e}")
 
-# Инициализация данных
-bot_settings = load_all_settings()
-stored_messages = load_messages()
+# Общее состояние в Redis: антиспам, автоудаление, переключатели настроек и сообщения
+def open_shared_state(settings):
+    """Подключается к Redis и возвращает общие реализации вместо локальных"""
+    client = RespClient.from_url(REDIS_URL)
+    return client, {
+        'limiter': SharedRateLimiter(client, burst=SPAM_BURST, interval=SPAM_INTERVAL, prefix=STATE_PREFIX),
+        'deletions': SharedDeletionScheduler(
+            client,
+            prefix=STATE_PREFIX,
+            concurrency=DELETE_CONCURRENCY,
+            chat_rate=DELETE_CHAT_RATE,
+            chat_burst=DELETE_CHAT_BURST,
+        ),
+        'settings': SharedSettings(client, settings, SHARED_SETTINGS, prefix=STATE_PREFIX),
+        'dedupe': SharedDeduplicator(client, prefix=STATE_PREFIX),
+        'notifier': SharedOwnerNotifier(client, NOTIFY_INTERVAL, prefix=STATE_PREFIX, worker=WORKER_NAME),
+        'messages': RedisMessageStore(
+            client,
+            prefix=STATE_PREFIX,
+            legacy_path=MESSAGES_FILE,
+            maxsize=WRITE_QUEUE_SIZE,
+            window=WRITE_WINDOW,
+            max_batch=WRITE_BATCH_SIZE,
+        ),
+    }
+
+# Данные загружаются в post_init, вне цикла событий
+bot_settings = SETTINGS
+message_store = None
+state_client = None
+
+async def off_loop(fn, *args):
+    """Вызов общего состояния: в режиме redis он ходит в сеть и выполняется в потоке,
+    локальные реализации работают в памяти и вызываются сразу"""
+    if state_client:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+async def refresh_shared_settings(context: CallbackContext):
+    """Подхватывает переключатели, измененные другими воркерами"""
+    try:
+        await asyncio.to_thread(bot_settings.refresh)
+    except Exception as e:
+        logger.error(f"Ошибка чтения общих настроек: {e}")
+
+async def post_init(application: Application):
+    """Загружает настройки и сообщения в отдельном потоке до начала обработки обновлений"""
+    global bot_settings, message_store, state_client, SPAM_LIMITER, SENT_MESSAGES, DEDUPE, OWNER_NOTIFIER
+    await asyncio.to_thread(initialize_settings)
+    await asyncio.to_thread(SETTINGS.load)
+    await asyncio.to_thread(FILE_IDS.load)
+    if STATE_BACKEND == 'redis':
+        state_client, state = await asyncio.to_thread(open_shared_state, SETTINGS)
+        SPAM_LIMITER = state['limiter']
+        SENT_MESSAGES = state['deletions']
+        DEDUPE = state['dedupe']
+        OWNER_NOTIFIER = state['notifier']
+        bot_settings = state['settings']
+        message_store = state['messages']
+        # Сообщения меняют и другие воркеры, а кэш экранов сбрасывается только локально
+        RENDER_CACHE.max_entries = 0
+        if application.job_queue:
+            application.job_queue.run_repeating(
+                refresh_shared_settings, interval=SHARED_SETTINGS_REFRESH, first=SHARED_SETTINGS_REFRESH
+            )
+    else:
+        message_store = await asyncio.to_thread(load_messages)
+    overdue = await asyncio.to_thread(
+        SENT_MESSAGES.open, DELETION_QUEUE_FILE, window=WRITE_WINDOW, fsync=FSYNC_POLICY
+    )
+    await asyncio.to_thread(OUTBOX.open, OUTBOX_FILE, window=WRITE_WINDOW, fsync=FSYNC_POLICY)
+    await asyncio.to_thread(DEDUPE.open, DEDUPE_FILE, window=WRITE_WINDOW, fsync=FSYNC_POLICY)
+    OUTBOX.start(application.bot)
+    await start_metrics_server()
+    # Просроченное за время простоя удаляется отдельной задачей, не задерживая запуск опроса
+    if overdue and application.job_queue:
+        application.job_queue.run_once(auto_delete_messages, 0)
+
+async def post_shutdown(application: Application):
+    """Дописывает очереди записи на диск при остановке"""
+    if METRICS_SERVER:
+        await METRICS_SERVER.stop()
+    await OUTBOX.stop()
+    if message_store:
+        await asyncio.to_thread(message_store.close)
+    await asyncio.to_thread(SENT_MESSAGES.close)
+    await asyncio.to_thread(DEDUPE.close)
+    if state_client:
+        state_client.close()
+
+async def start_metrics_server():
+    global METRICS_SERVER
+    if not METRICS_PORT:
+        return
+    server = MetricsServer(METRICS, listen=METRICS_LISTEN, port=METRICS_PORT)
+    try:
+        await server.start()
+    except OSError as e:
+        logger.error(f"Эндпоинт метрик не запущен: {e}")
+        return
+    METRICS_SERVER = server
 
 # Генерация уникальной ссылки
 def generate_invite_link(context):
@@ -129,17 +350,52 @@ def generate_invite_link(context):
 
 # Приветственное сообщение
 async def send_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    try:
-        await update.message.reply_animation(
-            animation=bot_settings['welcome_gif'],
+    # По URL Telegram каждый раз заново скачивает GIF, поэтому после первой
+    # отправки используется file_id; при смене welcome_gif.txt он не совпадет по хэшу
+    url = bot_settings['welcome_gif']
+    file_id = FILE_IDS.get('welcome_gif', url)
+    
+    async def reply(animation):
+        return await update.message.reply_animation(
+            animation=animation,
             caption=bot_settings['welcome_text'],
             parse_mode=None
         )
+    
+    try:
+        try:
+            sent = await reply(file_id or url)
+        except BadRequest:
+            if not file_id:
+                raise
+            logger.warning("Сохраненный file_id приветствия не принят, отправка по URL")
+            await asyncio.to_thread(FILE_IDS.forget, 'welcome_gif')
+            file_id = None
+            sent = await reply(url)
+        
+        media = sent.animation or sent.document
+        if not file_id and media:
+            await asyncio.to_thread(FILE_IDS.put, 'welcome_gif', url, media.file_id)
     except Exception as e:
         logger.error(f"Ошибка при отправке приветствия: {e}")
         await update.message.reply_text(bot_settings['welcome_text'])
 
+# Экран админ-панели
+def render_admin_panel():
+    def render():
+        new_count, total_count = message_store.counts()
+        
+        keyboard = [
+            [InlineKeyboardButton(f"💌 Сообщения ({new_count}/{total_count})", callback_data="view_messages")],
+            [InlineKeyboardButton("🔗 Получить ссылку", callback_data="get_link")],
+            [InlineKeyboardButton("🗄 Архив", callback_data="show_archive")],
+            [InlineKeyboardButton("📊 Статистика", callback_data="show_stats")],
+            [InlineKeyboardButton("⚙️ Основные настройки", callback_data="main_settings")]
+        ]
+        return "👑 *Админ-панель* ✨\n\nВыбери действие:", InlineKeyboardMarkup(keyboard)
+    
+    return RENDER_CACHE.get(('admin',), RENDER_CACHE.version(), render)
+
 # Админ-панель
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
@@ -147,22 +403,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔️ Доступ запрещен!")
         return
     
-    new_count = sum(1 for user_msgs in stored_messages.values() for msg in user_msgs if not msg.get('viewed', False))
-    total_count = sum(len(msgs) for msgs in stored_messages.values())
-    
-    keyboard = [
-        [InlineKeyboardButton(f"💌 Сообщения ({new_count}/{total_count})", callback_data="view_messages")],
-        [InlineKeyboardButton("🔗 Получить ссылку", callback_data="get_link")],
-        [InlineKeyboardButton("⚙️ Основные настройки", callback_data="main_settings")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        "👑 *Админ-панель* ✨\n\n"
-        "Выбери действие:",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
+    text, reply_markup = await off_loop(render_admin_panel)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
 
 # Основные настройки
 async def show_main_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -196,570 +438,270 @@ async def show_main_settings(update: Update, context: ContextTypes.DEFAULT_TYPE)
         parse_mode="Markdown"
     )
 
+# Кнопки листания страниц
+def page_buttons(prev_data, next_data):
+    row = []
+    if prev_data:
+        row.append(InlineKeyboardButton("◀️", callback_data=prev_data))
+    if next_data:
+        row.append(InlineKeyboardButton("▶️", callback_data=next_data))
+    return [row] if row else []
+
+# Экран списка пользователей
+def render_users_page(cursor):
+    def render():
+        users, next_cursor, prev_cursor = message_store.users_page(cursor, USERS_PAGE_SIZE)
+        if not users:
+            return None
+        
+        keyboard = []
+        for info in users:
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"{info['full_name']} (@{info['username']}) - {info['total']} сообщ. ({info['unread']} новых)",
+                    callback_data=f"user_msgs_{info['user_id']}"
+                )
+            ])
+        
+        keyboard += page_buttons(
+            f"users_page_{prev_cursor}" if prev_cursor is not None else None,
+            f"users_page_{next_cursor}" if next_cursor is not None else None
+        )
+        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_admin")])
+        text = "📬 *Накопленные сообщения* ✨\n\nВыберите пользователя для просмотра:"
+        return text, InlineKeyboardMarkup(keyboard)
+    
+    # Порядок и счетчики в списке зависят от всех пользователей
+    return RENDER_CACHE.get(('users', cursor), RENDER_CACHE.version(), render)
+
 # Просмотр сообщений
 async def view_accumulated_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    if not stored_messages:
+    # Курсор - позиция в индексе активности, -1 или его отсутствие - первая страница
+    cursor = None
+    if query.data.startswith("users_page_"):
+        cursor = int(query.data.replace("users_page_", ""))
+        if cursor < 0:
+            cursor = None
+    
+    page = await off_loop(render_users_page, cursor)
+    if page is None and cursor is not None:
+        # Курсор устарел - показываем первую страницу
+        page = await off_loop(render_users_page, None)
+    if page is None:
         await query.edit_message_text("📭 Нет накопленных сообщений!")
         return
     
-    keyboard = []
-    for user_id, messages in stored_messages.items():
-        new_count = sum(1 for msg in messages if not msg.get('viewed', False))
-        username = messages[0].get('username', 'без @username')
+    text, reply_markup = page
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+
+# Экран сообщений пользователя
+def render_user_page(user_id, offset):
+    def render():
+        messages, total = message_store.user_messages_page(user_id, offset, MESSAGES_PAGE_SIZE)
+        if not messages:
+            return None
+        
+        # Нумерация сквозная по всем страницам
+        message_list = []
+        for i, msg in enumerate(messages, offset + 1):
+            timestamp = datetime.fromisoformat(msg['timestamp']).strftime("%d.%m.%Y %H:%M")
+            content_preview = msg['content'][:100] + ('...' if len(msg['content']) > 100 else '')
+            message_list.append(f"📩 *Сообщение #{i}* ({timestamp}):\n{content_preview}")
+        
         full_name = messages[0].get('full_name', 'Неизвестный')
+        username = messages[0].get('username', 'без @username')
         
-        keyboard.append([
-            InlineKeyboardButton(
-                f"{full_name} (@{username}) - {len(messages)} сообщ. ({new_count} новых)",
-                callback_data=f"user_msgs_{user_id}"
-            )
-        ])
-    
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_admin")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        keyboard = page_buttons(
+            f"user_page_{user_id}_{max(0, offset - MESSAGES_PAGE_SIZE)}" if offset > 0 else None,
+            f"user_page_{user_id}_{offset + MESSAGES_PAGE_SIZE}" if offset + MESSAGES_PAGE_SIZE < total else None
+        )
+        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="view_messages")])
+        
+        pages = (total + MESSAGES_PAGE_SIZE - 1) // MESSAGES_PAGE_SIZE
+        text = (
+            f"📭 *Сообщения от {full_name} (@{username})* ✨\n"
+            f"Страница {offset // MESSAGES_PAGE_SIZE + 1} из {pages}\n\n" + "\n\n".join(message_list)
+        )
+        return text, InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(
-        "📬 *Накопленные сообщения* ✨\n\n"
-        "Выберите пользователя для просмотра:",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
+    return RENDER_CACHE.get(('user', user_id, offset), RENDER_CACHE.version(user_id), render)
 
 # Просмотр сообщений пользователя
 async def view_user_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    user_id = query.data.replace("user_msgs_", "")
-    messages = stored_messages.get(user_id, [])
+    # user_msgs_<id> - первая страница, user_page_<id>_<смещение> - следующие
+    if query.data.startswith("user_page_"):
+        user_id, offset = query.data.replace("user_page_", "").rsplit("_", 1)
+        offset = int(offset)
+    else:
+        user_id, offset = query.data.replace("user_msgs_", ""), 0
+    
+    # Помечаем как просмотренные (до отрисовки, чтобы не сбросить только что построенный экран)
+    if (await off_loop(message_store.user_counts, user_id))[1]:
+        message_store.mark_viewed(user_id)
+        RENDER_CACHE.invalidate(user_id)
     
-    if not messages:
+    page = await off_loop(render_user_page, user_id, offset)
+    if page is None:
         await query.answer("❌ Нет сообщений!")
         return
     
-    # Помечаем как просмотренные
-    for msg in messages:
-        msg['viewed'] = True
-    save_messages()
-    
-    # Формируем список
-    message_list = []
-    for i, msg in enumerate(messages, 1):
-        timestamp = datetime.fromisoformat(msg['timestamp']).strftime("%d.%m.%Y %H:%M")
-        content_preview = msg['content'][:100] + ('...' if len(msg['content']) > 100 else '')
-        message_list.append(f"📩 *Сообщение #{i}* ({timestamp}):\n{content_preview}")
-    
-    text = "\n\n".join(message_list)
-    full_name = messages[0].get('full_name', 'Неизвестный')
-    username = messages[0].get('username', 'без @username')
-    
-    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="view_messages")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(
-        f"📭 *Сообщения от {full_name} (@{username})* ✨\n\n{text}",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
-
-# Генерация ссылки
-async def generate_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    invite_link = generate_invite_link(context)
-    
-    keyboard = [[
-        InlineKeyboardButton("📤 Поделиться", url=f"https://t.me/share/url?url={invite_link}&text=Задай мне анонимный вопрос! ✨")
-    ], [InlineKeyboardButton("◀️ Назад", callback_data="back_to_admin")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(
-        "🔗 *Ваша ссылка для вопросов* ✨\n\n"
-        f"Используйте эту ссылку:\n\n"
-        f"👉 `{invite_link}`\n\n"
-        "Нажмите кнопку ниже, чтобы поделиться:",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
+    text, reply_markup = page
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
 
-# Обработка кнопок
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Архив сообщений
+async def show_archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    if query.data == "view_messages":
-        await view_accumulated_messages(update, context)
-    elif query.data == "get_link":
-        await generate_link(update, context)
-    elif query.data == "main_settings":
-        await show_main_settings(update, context)
-    elif query.data == "toggle_notify":
-        bot_settings['notify_owner'] = not bot_settings['notify_owner']
-        await show_main_settings(update, context)
-    elif query.data == "toggle_accumulate":
-        bot_settings['accumulate_mode'] = not bot_settings['accumulate_mode']
-        await show_main_settings(update, context)
-    elif query.data.startswith("user_msgs_"):
-        await view_user_messages(update, context)
-    elif query.data in ["back_to_admin", "back_to_main"]:
-        await admin_panel_callback(update, context)
-
-# Обработчик /start
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await send_welcome_message(update, context)
-
-# Автоудаление сообщений
-async def auto_delete_messages(context: CallbackContext):
-    global SENT_MESSAGES
-    current_time = datetime.now()
-    
-    for msg_data in SENT_MESSAGES[:]:
-        if (current_time - msg_data['timestamp']) > timedelta(minutes=25):
-            try:
-                await context.bot.delete_message(
-                    chat_id=msg_data['chat_id'],
-                    message_id=msg_data['message_id']
-                )
-                SENT_MESSAGES.remove(msg_data)
-                logger.info(f"Сообщение удалено: {msg_data['message_id']}")
-            except Exception as e:
-                logger.error(f"Ошибка удаления: {e}")
-
-# Отправка в канал
-async def send_to_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        # Антиспам
-        user_id = update.message.from_user.id
-        current_time = datetime.now()
-        
-        if user_id in USER_LAST_MESSAGE:
-            if (current_time - USER_LAST_MESSAGE[user_id]).seconds < 10:
-                warning = await update.message.reply_text("⏳ Подождите 10 секунд!")
-                await asyncio.sleep(3)
-                await warning.delete()
-                return
-        USER_LAST_MESSAGE[user_id] = current_time
-        
-        # Пропуск команд
-        if update.message.text and update.message.text.startswith('/'):
-            return
-            
-        user = update.message.from_user
-        content = update.message.text or update.message.caption or "Медиа-файл"
-        
-        # Форматирование сообщения
-        formatted_message = bot_settings['channel_template'].format(content=content)
-        
-        # Отправка в канал
-        sent_message = None
-        if update.message.text:
-            sent_message = await context.bot.send_message(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                text=formatted_message
-            )
-        elif update.message.photo:
-            sent_message = await context.bot.send_photo(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                photo=update.message.photo[-1].file_id,
-                caption=formatted_message
-            )
-        elif update.message.video:
-            sent_message = await context.bot.send_video(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                video=update.message.video.file_id,
-                caption=formatted_message
-            )
-        elif update.message.document:
-            sent_message = await context.bot.send_document(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                document=update.message.document.file_id,
-                caption=formatted_message
-            )
-        elif update.message.audio:
-            sent_message = await context.bot.send_audio(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                audio=update.message.audio.file_id,
-                caption=formatted_message
-            )
-        elif update.message.voice:
-            sent_message = await context.bot.send_voice(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                voice=update.message.voice.file_id,
-                caption=formatted_message
-            )
-        elif update.message.sticker:
-            sent_message = await context.bot.send_sticker(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                sticker=update.message.sticker.file_id
-            )
-        elif update.message.animation:
-            sent_message = await context.bot.send_animation(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                animation=update.message.animation.file_id,
-                caption=formatted_message
-            )
-        
-        # Сохранение для автоудаления
-        if sent_message:
-            SENT_MESSAGES.append({
-                'message_id': sent_message.message_id,
-                'chat_id': context.bot_data['CHANNEL_ID'],
-                'timestamp': datetime.now()
-            })
-        
-        # Сохранение для владельца
-        user_id = str(user.id)
-        if user_id not in stored_messages:
-            stored_messages[user_id] = []
-        
-        stored_messages[user_id].append({
-            'timestamp': datetime.now().isoformat(),
-            'type': 'text',
-            'content': content,
-            'full_name': user.full_name,
-            'username': user.username,
-            'viewed': False
-        })
-        save_messages()
-        
-        # Подтверждение
-        confirmation = await update.message.reply_text(
-            "✨ *Сообщение отправлено!* 💖\n"
-            "Это подтверждение исчезнет через несколько секунд...",
-            parse_mode="Markdown"
+    stats = await asyncio.to_thread(ARCHIVE.stats)
+    if stats['files']:
+        summary = (
+            f"📅 С {stats['first']} по {stats['last']}\n"
+            f"📁 Файлов: {stats['files']} ({stats['bytes'] / 1024:.0f} КБ)"
         )
-        await update.message.delete()
-        await asyncio.sleep(DELETE_DELAY)
-        await confirmation.delete()
-        
-        # Статистика
-        context.bot_data['message_count'] = context.bot_data.get('message_count', 0) + 1
-        
-    except Exception as e:
-        logger.error(f"Ошибка: {e}")
-        await update.message.reply_text("⚠️ Не удалось отправить сообщение!")
-
-# Админ-панель через callback
-async def admin_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    new_count = sum(1 for user_msgs in stored_messages.values() for msg in user_msgs if not msg.get('viewed', False))
-    total_count = sum(len(msgs) for msgs in stored_messages.values())
-    
-    keyboard = [
-        [InlineKeyboardButton(f"💌 Сообщения ({new_count}/{total_count})", callback_data="view_messages")],
-        [InlineKeyboardButton("🔗 Получить ссылку", callback_data="get_link")],
-        [InlineKeyboardButton("⚙️ Основные настройки", callback_data="main_settings")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    else:
+        summary = "📭 Архив пока пуст"
     
+    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_admin")]]
     await query.edit_message_text(
-        "👑 *Админ-панель* ✨\n\nВыбери действие:",
-        reply_markup=reply_markup,
+        "🗄 *Архив сообщений* ✨\n\n"
+        f"{summary}\n\n"
+        "Поиск: `/archive <id или @username> [с даты] [по дату]`, даты в формате ГГГГ-ММ-ДД",
+        reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode="Markdown"
     )
 
-def main():
-    from config import BOT_TOKEN, CHANNEL_ID, OWNER_ID
-    
-    application = Application.builder().token(BOT_TOKEN).build()
-    application.bot_data['CHANNEL_ID'] = CHANNEL_ID
-    application.bot_data['OWNER_ID'] = OWNER_ID
-    application.bot_data['message_count'] = 0
-    
-    # Обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("admin", admin_panel))
-    
-    # Обработчики кнопок
-    application.add_handler(CallbackQueryHandler(button_handler))
-    
-    # Обработчики сообщений
-    application.add_handler(MessageHandler(
-        filters.ALL & ~filters.COMMAND, 
-        send_to_channel
-    ))
-    
-    # Автоудаление
-    job_queue = application.job_queue
-    if job_queue:
-        job_queue.run_repeating(auto_delete_messages, interval=60, first=10)
-    
-    logger.info("Бот запущен...")
-    application.run_polling()
-
-if __name__ == "__main__":
-    main() import logging
-import asyncio
-import os
-import json
-import secrets
-import re
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (
-    Application,
-    MessageHandler,
-    filters,
-    ContextTypes,
-    CommandHandler,
-    CallbackQueryHandler,
-    CallbackContext
-)
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# Константы
-DELETE_DELAY = 5
-SETTINGS_DIR = "Settings"
-MESSAGES_FILE = "stored_messages.json"
-USER_LAST_MESSAGE = {}
-SENT_MESSAGES = []
-
-# Стандартные настройки
-DEFAULT_SETTINGS = {
-    'welcome_text': "₊⊹  Приветик⋆˚꩜｡\n\nೀ 🍨 ‧ ˚ 🎀 ⊹˚. ♡\n\n♡⸝⸝  Я ботик для анонимных сообщений :3\n˚ʚОтправь мне сообщение - и я его доставлю куда нужноɞ˚\n🐾 by @Bbl_KOH4EHblE",
-    'welcome_gif': "https://media.tenor.com/4YmoLrHy-yoAAAAi/vtuber-anime-girl.gif",
-    'channel_template': "💬 {content}",
-    'tagline': "💌 Анонимное сообщение",
-    'notify_owner': True,
-    'accumulate_mode': False,
-}
-
-# Создание папки Settings и файлов настроек если их нет
-def initialize_settings():
-    """Создает папку Settings и файлы настроек с дефолтными значениями"""
-    try:
-        # Создаем папку если её нет
-        if not os.path.exists(SETTINGS_DIR):
-            os.makedirs(SETTINGS_DIR)
-            logger.info(f"Создана папка настроек: {SETTINGS_DIR}")
-        
-        # Список файлов настроек
-        setting_files = {
-            'welcome_text.txt': DEFAULT_SETTINGS['welcome_text'],
-            'welcome_gif.txt': DEFAULT_SETTINGS['welcome_gif'],
-            'channel_template.txt': DEFAULT_SETTINGS['channel_template'],
-            'tagline.txt': DEFAULT_SETTINGS['tagline'],
-        }
-        
-        # Создаем файлы с дефолтными значениями
-        for filename, default_value in setting_files.items():
-            file_path = os.path.join(SETTINGS_DIR, filename)
-            if not os.path.exists(file_path):
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(default_value)
-                logger.info(f"Создан файл настроек: {filename}")
-        
-        logger.info("Настройки инициализированы")
-    except Exception as e:
-        logger.error(f"Ошибка инициализации настроек: {e}")
-
-# Инициализация настроек при импорте
-initialize_settings()
-
-# Функции для работы с файлами настроек
-def load_setting(setting_name):
-    """Загружает настройку из файла"""
-    try:
-        file_path = os.path.join(SETTINGS_DIR, f"{setting_name}.txt")
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read().strip()
-        return DEFAULT_SETTINGS.get(setting_name, "")
-    except Exception as e:
-        logger.error(f"Ошибка загрузки {setting_name}: {e}")
-        return DEFAULT_SETTINGS.get(setting_name, "")
-
-def load_all_settings():
-    """Загружает все настройки из файлов"""
-    return {
-        'welcome_text': load_setting('welcome_text'),
-        'welcome_gif': load_setting('welcome_gif'),
-        'channel_template': load_setting('channel_template'),
-        'tagline': load_setting('tagline'),
-        'notify_owner': DEFAULT_SETTINGS['notify_owner'],
-        'accumulate_mode': DEFAULT_SETTINGS['accumulate_mode']
-    }
-
-# Загрузка сообщений
-def load_messages():
-    """Загружает сообщения из файла"""
-    try:
-        if os.path.exists(MESSAGES_FILE):
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
-    except Exception as e:
-        logger.error(f"Ошибка загрузки сообщений: {e}")
-        return {}
-
-def save_messages():
-    """Сохраняет сообщения в файл"""
-    try:
-        with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(stored_messages, f, indent=4, default=str)
-        logger.info("Сообщения сохранены")
-    except Exception as e:
-        logger.error(f"Ошибка сохранения сообщений: {e}")
-
-# Инициализация данных
-bot_settings = load_all_settings()
-stored_messages = load_messages()
-
-# Генерация уникальной ссылки
-def generate_invite_link(context):
-    code = secrets.token_urlsafe(6)[:8]
-    bot_username = context.bot.username
-    return f"https://t.me/{bot_username}?start={code}"
-
-# Приветственное сообщение
-async def send_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    try:
-        await update.message.reply_animation(
-            animation=bot_settings['welcome_gif'],
-            caption=bot_settings['welcome_text'],
-            parse_mode=None
+# Статистика работы бота
+def render_stats():
+    uptime = int(time.time() - METRICS.started)
+    lines = [f"⏱ Работает: {uptime // 3600} ч {uptime % 3600 // 60} мин", "", "*Обработчики* (вызовов, p50/p95, ошибок):"]
+    for labels, histogram in sorted(METRICS.histograms('handler_seconds').items()):
+        name = dict(labels)['handler']
+        errors = METRICS.counter('handler_errors_total', handler=name)
+        lines.append(
+            f"`{name}`: {histogram.count}, "
+            f"{histogram.quantile(0.5) * 1000:.0f}/{histogram.quantile(0.95) * 1000:.0f} мс, {errors}"
         )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке приветствия: {e}")
-        await update.message.reply_text(bot_settings['welcome_text'])
-
-# Админ-панель
-async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    if user.id != context.bot_data['OWNER_ID']:
-        await update.message.reply_text("⛔️ Доступ запрещен!")
-        return
     
-    new_count = sum(1 for user_msgs in stored_messages.values() for msg in user_msgs if not msg.get('viewed', False))
-    total_count = sum(len(msgs) for msgs in stored_messages.values())
+    lines += ["", "*Bot API* (вызовов, среднее время):"]
+    api = sorted(METRICS.histograms('api_seconds').items(), key=lambda item: -item[1].count)
+    for labels, histogram in api[:10]:
+        lines.append(f"`{dict(labels)['method']}`: {histogram.count}, {histogram.sum / histogram.count * 1000:.0f} мс")
+    flood = sum(METRICS.counters('api_flood_total').values())
+    errors = sum(METRICS.counters('api_errors_total').values())
+    lines.append(f"⚠️ 429: {flood}, ошибок: {errors}")
     
-    keyboard = [
-        [InlineKeyboardButton(f"💌 Сообщения ({new_count}/{total_count})", callback_data="view_messages")],
-        [InlineKeyboardButton("🔗 Получить ссылку", callback_data="get_link")],
-        [InlineKeyboardButton("⚙️ Основные настройки", callback_data="main_settings")]
+    gauges = METRICS.gauges()
+    memory = gauges.get('antispam_memory_bytes')
+    antispam_memory = f"~{memory / 1024:.0f} КБ" if memory is not None else "—"
+    lines += [
+        "",
+        f"🗑 Ждут удаления: {gauges.get('pending_deletions', '—')}",
+        f"📤 В очереди отправки: {gauges.get('outbox_pending', 0)} (в дайджесте {gauges.get('outbox_digest_buffered', 0)})",
+        f"🛡 Антиспам: {gauges.get('antispam_users', '—')} польз., отклонено {gauges.get('antispam_rejected', 0)}, "
+        f"память {antispam_memory}",
+        f"📨 Принято постов: {METRICS.counter('posts_total')}",
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        "👑 *Админ-панель* ✨\n\n"
-        "Выбери действие:",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
+    return "📊 *Статистика* ✨\n\n" + "\n".join(lines)
 
-# Основные настройки
-async def show_main_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
+    # Не кэшируется: значения меняются с каждым обновлением
+    text = render_stats()
     keyboard = [
-        [
-            InlineKeyboardButton(
-                f"🔔 Уведомления: {'✅ ВКЛ' if bot_settings['notify_owner'] else '❌ ВЫКЛ'}",
-                callback_data="toggle_notify"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                f"📦 Накопление: {'✅ ВКЛ' if bot_settings['accumulate_mode'] else '❌ ВЫКЛ'}",
-                callback_data="toggle_accumulate"
-            )
-        ],
-        [InlineKeyboardButton("◀️ Назад", callback_data="back_to_admin")]
+        [InlineKeyboardButton("🔄 Обновить", callback_data="show_stats")],
+        [InlineKeyboardButton("◀️ Назад", callback_data="back_to_admin")],
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(
-        "⚙️ *Основные настройки* ✨\n\n"
-        f"🔔 Уведомления: {'Включены' if bot_settings['notify_owner'] else 'Выключены'}\n"
-        f"📦 Режим накопления: {'Включен' if bot_settings['accumulate_mode'] else 'Выключен'}\n\n"
-        "ℹ️ Настройки контента (приветствие, гифка, формат сообщений) редактируются "
-        "только через файлы в папке Settings",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
-# Просмотр сообщений
-async def view_accumulated_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    if not stored_messages:
-        await query.edit_message_text("📭 Нет накопленных сообщений!")
+# Поиск в архиве
+async def archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != context.bot_data['OWNER_ID']:
+        await update.message.reply_text("⛔️ Доступ запрещен!")
         return
     
-    keyboard = []
-    for user_id, messages in stored_messages.items():
-        new_count = sum(1 for msg in messages if not msg.get('viewed', False))
-        username = messages[0].get('username', 'без @username')
-        full_name = messages[0].get('full_name', 'Неизвестный')
-        
-        keyboard.append([
-            InlineKeyboardButton(
-                f"{full_name} (@{username}) - {len(messages)} сообщ. ({new_count} новых)",
-                callback_data=f"user_msgs_{user_id}"
-            )
-        ])
+    args = context.args or []
+    if not args:
+        await update.message.reply_text("Использование: /archive <id или @username> [с даты] [по дату]")
+        return
     
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_admin")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    who = args[0]
+    dates = args[1:3]
+    try:
+        for day in dates:
+            datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        await update.message.reply_text("❌ Даты указываются в формате ГГГГ-ММ-ДД")
+        return
     
-    await query.edit_message_text(
-        "📬 *Накопленные сообщения* ✨\n\n"
-        "Выберите пользователя для просмотра:",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
+    found = await asyncio.to_thread(
+        ARCHIVE.query,
+        user_id=None if who.startswith('@') else who,
+        username=who[1:] if who.startswith('@') else None,
+        since=dates[0] if dates else None,
+        until=dates[1] if len(dates) > 1 else None,
+        limit=ARCHIVE_QUERY_LIMIT
     )
-
-# Просмотр сообщений пользователя
-async def view_user_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    user_id = query.data.replace("user_msgs_", "")
-    messages = stored_messages.get(user_id, [])
-    
-    if not messages:
-        await query.answer("❌ Нет сообщений!")
+    if not found:
+        await update.message.reply_text("📭 В архиве ничего не найдено")
         return
     
-    # Помечаем как просмотренные
-    for msg in messages:
-        msg['viewed'] = True
-    save_messages()
+    lines = []
+    for user_id, msg in found:
+        try:
+            timestamp = datetime.fromisoformat(msg['timestamp']).strftime("%d.%m.%Y %H:%M")
+        except (TypeError, ValueError):
+            timestamp = str(msg.get('timestamp'))
+        content = msg.get('content') or ''
+        content_preview = content[:100] + ('...' if len(content) > 100 else '')
+        lines.append(f"📩 {timestamp}, {msg.get('full_name')} ({user_id}):\n{content_preview}")
+    await update.message.reply_text(f"🗄 Найдено в архиве: {len(found)}\n\n" + "\n\n".join(lines))
+
+# Перенос старых сообщений в архив
+async def archive_messages(context: CallbackContext):
+    if RETENTION_MAX_AGE is None and RETENTION_PER_USER is None and RETENTION_TOTAL is None:
+        return
     
-    # Формируем список
-    message_list = []
-    for i, msg in enumerate(messages, 1):
-        timestamp = datetime.fromisoformat(msg['timestamp']).strftime("%d.%m.%Y %H:%M")
-        content_preview = msg['content'][:100] + ('...' if len(msg['content']) > 100 else '')
-        message_list.append(f"📩 *Сообщение #{i}* ({timestamp}):\n{content_preview}")
+    # С общим состоянием архивирует один воркер за интервал, иначе сообщения удалились бы дважды
+    if state_client and not await asyncio.to_thread(
+        state_client.execute, 'SET', f"{STATE_PREFIX}archive_lock", WORKER_NAME or '1', 'NX', 'PX', ARCHIVE_INTERVAL * 1000
+    ):
+        return
     
-    text = "\n\n".join(message_list)
-    full_name = messages[0].get('full_name', 'Неизвестный')
-    username = messages[0].get('username', 'без @username')
+    def archive():
+        # Архивируется только то, что уже на диске (SQLite читает с диска)
+        message_store.flush()
+        drops = message_store.expired(
+            max_age=RETENTION_MAX_AGE, max_per_user=RETENTION_PER_USER, max_total=RETENTION_TOTAL
+        )
+        for user_id, count in drops.items():
+            ARCHIVE.append(user_id, message_store.oldest_messages(user_id, count))
+        return drops
     
-    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="view_messages")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    try:
+        drops = await asyncio.to_thread(archive)
+    except Exception as e:
+        logger.error(f"Ошибка архивации сообщений: {e}")
+        return
     
-    await query.edit_message_text(
-        f"📭 *Сообщения от {full_name} (@{username})* ✨\n\n{text}",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
+    # Удаляем из хранилища только после записи в архив: при сбое сообщение
+    # может попасть в архив дважды, но не потеряется
+    for user_id, count in drops.items():
+        message_store.drop_oldest(user_id, count)
+        if (await off_loop(message_store.user_counts, user_id))[0]:
+            RENDER_CACHE.invalidate(user_id)
+        else:
+            RENDER_CACHE.forget(user_id)
+    if drops:
+        logger.info(f"В архив перенесено {sum(drops.values())} сообщений от {len(drops)} пользователей")
 
 # Генерация ссылки
 async def generate_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -787,19 +729,25 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    if query.data == "view_messages":
+    if query.data == "view_messages" or query.data.startswith("users_page_"):
         await view_accumulated_messages(update, context)
     elif query.data == "get_link":
         await generate_link(update, context)
+    elif query.data == "show_archive":
+        await show_archive(update, context)
+    elif query.data == "show_stats":
+        await show_stats(update, context)
     elif query.data == "main_settings":
         await show_main_settings(update, context)
     elif query.data == "toggle_notify":
-        bot_settings['notify_owner'] = not bot_settings['notify_owner']
+        await off_loop(bot_settings.__setitem__, 'notify_owner', not bot_settings['notify_owner'])
         await show_main_settings(update, context)
     elif query.data == "toggle_accumulate":
-        bot_settings['accumulate_mode'] = not bot_settings['accumulate_mode']
+        await off_loop(bot_settings.__setitem__, 'accumulate_mode', not bot_settings['accumulate_mode'])
+        if not bot_settings['accumulate_mode']:
+            OUTBOX.flush_digest()
         await show_main_settings(update, context)
-    elif query.data.startswith("user_msgs_"):
+    elif query.data.startswith(("user_msgs_", "user_page_")):
         await view_user_messages(update, context)
     elif query.data in ["back_to_admin", "back_to_main"]:
         await admin_panel_callback(update, context)
@@ -808,119 +756,211 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_welcome_message(update, context)
 
+# Отложенное удаление служебных сообщений
+async def delete_message_job(context: CallbackContext):
+    chat_id, message_id = context.job.data
+    try:
+        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.warning(f"Не удалось удалить сообщение {message_id}: {e}")
+
+async def delete_later(bot, chat_id, message_id, delay):
+    await asyncio.sleep(delay)
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.warning(f"Не удалось удалить сообщение {message_id}: {e}")
+
+def schedule_delete(context: ContextTypes.DEFAULT_TYPE, message, delay):
+    """Планирует удаление сообщения, не задерживая обработчик"""
+    if context.job_queue:
+        context.job_queue.run_once(delete_message_job, delay, data=(message.chat_id, message.message_id))
+    else:
+        context.application.create_task(delete_later(context.bot, message.chat_id, message.message_id, delay))
+
 # Автоудаление сообщений
 async def auto_delete_messages(context: CallbackContext):
-    global SENT_MESSAGES
-    current_time = datetime.now()
-    
-    for msg_data in SENT_MESSAGES[:]:
-        if (current_time - msg_data['timestamp']) > timedelta(minutes=25):
-            try:
-                await context.bot.delete_message(
-                    chat_id=msg_data['chat_id'],
-                    message_id=msg_data['message_id']
-                )
-                SENT_MESSAGES.remove(msg_data)
-                logger.info(f"Сообщение удалено: {msg_data['message_id']}")
-            except Exception as e:
-                logger.error(f"Ошибка удаления: {e}")
+    await SENT_MESSAGES.run(context.bot)
+
+# Сводка новых сообщений владельцу
+async def notify_owner(context: CallbackContext):
+    new_messages, users = await off_loop(OWNER_NOTIFIER.take)
+    if not new_messages or not bot_settings['notify_owner']:
+        return
+    
+    keyboard = [[InlineKeyboardButton("💌 Открыть сообщения", callback_data="view_messages")]]
+    try:
+        await context.bot.send_message(
+            chat_id=context.bot_data['OWNER_ID'],
+            text=f"🔔 Новых сообщений: {new_messages} (пользователей: {users})",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления владельца: {e}")
+
+# Публикация дайджеста в режиме накопления
+async def publish_digest(context: CallbackContext):
+    OUTBOX.flush_digest()
+
+# Типы содержимого сообщения; порядок важен: у анимации есть и document, у места - location
+MESSAGE_TYPES = (
+    'text', 'animation', 'photo', 'video', 'video_note', 'voice', 'audio', 'document',
+    'sticker', 'venue', 'location', 'contact', 'poll', 'dice', 'story', 'paid_media',
+)
+
+def message_type(message):
+    return next((t for t in MESSAGE_TYPES if getattr(message, t, None)), 'other')
+
+# Пост в канал по умолчанию - копия сообщения (copyMessage) с шаблоном вместо подписи.
+# Типы, к которым шаблон применяется иначе, регистрируют свой хук:
+# hook(message, channel_id, formatted) -> (метод бота, аргументы)
+RELAY_HOOKS = {}
+
+def relay_hook(*types):
+    def register(hook):
+        for t in types:
+            RELAY_HOOKS[t] = hook
+        return hook
+    return register
+
+@relay_hook('text')
+def relay_text(message, channel_id, formatted):
+    """У текста нет подписи: шаблон применяется к самому тексту"""
+    return 'send_message', {'chat_id': channel_id, 'text': formatted}
+
+@relay_hook('sticker', 'video_note', 'venue', 'location', 'contact', 'poll', 'dice')
+def relay_as_is(message, channel_id, formatted):
+    """Подпись к этим типам не добавить: копия уходит без шаблона"""
+    return 'copy_message', {'chat_id': channel_id, 'from_chat_id': message.chat_id, 'message_id': message.message_id}
+
+def relay_job(message, channel_id, formatted):
+    """Метод и аргументы поста в канал для сообщения любого типа"""
+    hook = RELAY_HOOKS.get(message_type(message))
+    if hook:
+        return hook(message, channel_id, formatted)
+    return 'copy_message', {
+        'chat_id': channel_id,
+        'from_chat_id': message.chat_id,
+        'message_id': message.message_id,
+        'caption': formatted,
+    }
+
+# Ключ содержимого для отсева повторов: тот же текст, файл, точка на карте, контакт
+# или опрос от того же пользователя. У кубика и подобных типов устойчивого
+# содержимого нет (каждый бросок - новое значение), для них ключ не строится
+def content_key(message):
+    kind = message_type(message)
+    attachment = message.photo[-1] if kind == 'photo' else getattr(message, kind, None)
+    parts = [kind, message.text or message.caption or ""]
+    if kind == 'text':
+        pass
+    elif getattr(attachment, 'file_unique_id', None):
+        parts.append(attachment.file_unique_id)
+    elif kind == 'location':
+        parts += [attachment.latitude, attachment.longitude]
+    elif kind == 'venue':
+        parts += [attachment.location.latitude, attachment.location.longitude, attachment.title, attachment.address]
+    elif kind == 'contact':
+        parts += [attachment.phone_number, attachment.first_name, attachment.last_name, attachment.user_id]
+    elif kind == 'poll':
+        parts += [attachment.type, attachment.question, *(option.text for option in attachment.options)]
+    else:
+        return None
+    digest = hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8'))
+    return f"content:{message.from_user.id}:{digest.hexdigest()[:32]}"
 
 # Отправка в канал
 async def send_to_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    claimed = []
+    posted = False
     try:
-        # Антиспам
-        user_id = update.message.from_user.id
-        current_time = datetime.now()
+        # Повторная доставка обновления - молча пропускаем
+        update_key = f"update:{update.update_id}"
+        if await off_loop(DEDUPE.seen, update_key):
+            return
         
-        if user_id in USER_LAST_MESSAGE:
-            if (current_time - USER_LAST_MESSAGE[user_id]).seconds < 10:
-                warning = await update.message.reply_text("⏳ Подождите 10 секунд!")
-                await asyncio.sleep(3)
-                await warning.delete()
-                return
-        USER_LAST_MESSAGE[user_id] = current_time
+        # То же сообщение еще раз (двойное нажатие "отправить") - в пределах интервала
+        # антиспама, поэтому ответ тот же, что и у антиспама
+        user_id = update.message.from_user.id
+        message_key = content_key(update.message)
+        duplicate = message_key and await off_loop(DEDUPE.seen, message_key)
+        if duplicate or not await off_loop(SPAM_LIMITER.allow, user_id):
+            warning = await update.message.reply_text(f"⏳ Подождите {SPAM_INTERVAL} секунд!")
+            schedule_delete(context, warning, WARNING_DELAY)
+            return
         
         # Пропуск команд
         if update.message.text and update.message.text.startswith('/'):
             return
-            
+        
         user = update.message.from_user
         content = update.message.text or update.message.caption or "Медиа-файл"
         
         # Форматирование сообщения
-        formatted_message = bot_settings['channel_template'].format(content=content)
+        formatted_message = SETTINGS.template('channel_template').format(content=content)
         
-        # Отправка в канал
-        sent_message = None
-        if update.message.text:
-            sent_message = await context.bot.send_message(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                text=formatted_message
-            )
-        elif update.message.photo:
-            sent_message = await context.bot.send_photo(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                photo=update.message.photo[-1].file_id,
-                caption=formatted_message
-            )
-        elif update.message.video:
-            sent_message = await context.bot.send_video(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                video=update.message.video.file_id,
-                caption=formatted_message
-            )
-        elif update.message.document:
-            sent_message = await context.bot.send_document(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                document=update.message.document.file_id,
-                caption=formatted_message
-            )
-        elif update.message.audio:
-            sent_message = await context.bot.send_audio(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                audio=update.message.audio.file_id,
-                caption=formatted_message
-            )
-        elif update.message.voice:
-            sent_message = await context.bot.send_voice(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                voice=update.message.voice.file_id,
-                caption=formatted_message
-            )
-        elif update.message.sticker:
-            sent_message = await context.bot.send_sticker(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                sticker=update.message.sticker.file_id
-            )
-        elif update.message.animation:
-            sent_message = await context.bot.send_animation(
-                chat_id=context.bot_data['CHANNEL_ID'],
-                animation=update.message.animation.file_id,
-                caption=formatted_message
+        # Пост в канал: в дайджест или сразу
+        message = update.message
+        channel_id = context.bot_data['CHANNEL_ID']
+        digest = None
+        if bot_settings['accumulate_mode'] and message.text:
+            digest = {'text': formatted_message}
+        elif bot_settings['accumulate_mode'] and (message.photo or message.video or message.document or message.audio):
+            media_type = next(t for t in ('photo', 'video', 'document', 'audio') if getattr(message, t))
+            media = message.photo[-1] if media_type == 'photo' else getattr(message, media_type)
+            digest = {'media_type': media_type, 'media': media.file_id, 'caption': formatted_message}
+        else:
+            method, kwargs = relay_job(message, channel_id, formatted_message)
+        
+        # Telegram отклонит слишком длинный текст или подпись уже после подтверждения -
+        # проверяем заранее, с учетом шаблона
+        too_long = length_error(digest or kwargs)
+        if too_long:
+            _, limit = too_long
+            allowed = limit - (telegram_length(formatted_message) - telegram_length(content))
+            warning = await update.message.reply_text(
+                f"⚠️ Сообщение слишком длинное: можно не больше {max(allowed, 0)} символов"
             )
+            schedule_delete(context, warning, WARNING_DELAY)
+            return
+            
+        # Ключи занимаются до постановки в очередь: параллельный повтор (в том числе
+        # в другом воркере) получит None и ничего не отправит
+        keys = [(update_key, UPDATE_DEDUPE_TTL)]
+        if message_key:
+            keys.append((message_key, CONTENT_DEDUPE_TTL))
+        for key, ttl in keys:
+            written = await off_loop(DEDUPE.claim, key, ttl)
+            if written is None:
+                return
+            claimed.append((key, written))
         
-        # Сохранение для автоудаления
-        if sent_message:
-            SENT_MESSAGES.append({
-                'message_id': sent_message.message_id,
-                'chat_id': context.bot_data['CHANNEL_ID'],
-                'timestamp': datetime.now()
-            })
+        # Постановка в очередь отправки в канал
+        relayed = digest is None
+        if relayed:
+            queued = OUTBOX.enqueue(method, source=(message.chat_id, message.message_id), **kwargs)
+        else:
+            queued = OUTBOX.enqueue_digest(channel_id, **digest)
+        # Задание уже у очереди отправки и уйдет в канал, даже если дальше что-то сломается:
+        # с этого момента ключи не освобождаются, иначе повтор пользователя даст второй пост
+        posted = True
         
         # Сохранение для владельца
-        user_id = str(user.id)
-        if user_id not in stored_messages:
-            stored_messages[user_id] = []
-        
-        stored_messages[user_id].append({
+        saved = message_store.add_message(str(user.id), {
             'timestamp': datetime.now().isoformat(),
-            'type': 'text',
+            'type': message_type(message),
             'content': content,
             'full_name': user.full_name,
             'username': user.username,
             'viewed': False
         })
-        save_messages()
+        # Подтверждаем только после записи поста и сообщения на диск (с учетом FSYNC_POLICY),
+        # сама отправка в канал идет в фоне с учетом лимитов Telegram
+        written = [future for _, future in claimed]
+        await asyncio.gather(*(asyncio.wrap_future(f) for f in (queued, saved, *written) if f))
+        # Экраны сбрасываются после записи: SQLite-хранилище читает страницы с диска
+        RENDER_CACHE.invalidate(user.id)
+        await off_loop(OWNER_NOTIFIER.add, user.id)
         
         # Подтверждение
         confirmation = await update.message.reply_text(
@@ -928,15 +968,23 @@ async def send_to_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Это подтверждение исчезнет через несколько секунд...",
             parse_mode="Markdown"
         )
-        await update.message.delete()
-        await asyncio.sleep(DELETE_DELAY)
-        await confirmation.delete()
+        # Исходное сообщение для копии удаляется после публикации (on_channel_post)
+        if not relayed:
+            await update.message.delete()
+        schedule_delete(context, confirmation, DELETE_DELAY)
         
         # Статистика
         context.bot_data['message_count'] = context.bot_data.get('message_count', 0) + 1
+        METRICS.inc('posts_total')
         
     except Exception as e:
         logger.error(f"Ошибка: {e}")
+        if posted:
+            # Пост будет опубликован - сообщать об ошибке и звать повторить нельзя
+            return
+        # Пост не ушел в очередь - повтор от пользователя должен пройти
+        for key, _ in claimed:
+            await off_loop(DEDUPE.release, key)
         await update.message.reply_text("⚠️ Не удалось отправить сообщение!")
 
 # Админ-панель через callback
@@ -944,47 +992,112 @@ async def admin_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     
-    new_count = sum(1 for user_msgs in stored_messages.values() for msg in user_msgs if not msg.get('viewed', False))
-    total_count = sum(len(msgs) for msgs in stored_messages.values())
+    text, reply_markup = await off_loop(render_admin_panel)
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+
+# Режим вебхука
+async def run_webhook(application, config):
+    """Аналог run_polling: обновления приходят во встроенный HTTP-сервер"""
+    cert = getattr(config, 'WEBHOOK_CERT', '')
+    key = getattr(config, 'WEBHOOK_KEY', '')
+    secret_token = getattr(config, 'WEBHOOK_SECRET_TOKEN', '') or None
+    server = WebhookServer(
+        application,
+        listen=getattr(config, 'WEBHOOK_LISTEN', '0.0.0.0'),
+        port=int(os.environ.get('BOT_WEBHOOK_PORT', getattr(config, 'WEBHOOK_PORT', 8443))),
+        url_path=getattr(config, 'WEBHOOK_PATH', '/telegram'),
+        secret_token=secret_token,
+        ssl_context=make_ssl_context(cert, key) if cert and key else None,
+    )
     
-    keyboard = [
-        [InlineKeyboardButton(f"💌 Сообщения ({new_count}/{total_count})", callback_data="view_messages")],
-        [InlineKeyboardButton("🔗 Получить ссылку", callback_data="get_link")],
-        [InlineKeyboardButton("⚙️ Основные настройки", callback_data="main_settings")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
     
-    await query.edit_message_text(
-        "👑 *Админ-панель* ✨\n\nВыбери действие:",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
+    # Тот же порядок, что у run_polling: initialize -> post_init -> start ... stop -> shutdown -> post_shutdown
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        certificate = open(cert, 'rb') if cert else None
+        try:
+            await application.bot.set_webhook(
+                url=config.WEBHOOK_URL,
+                certificate=certificate,
+                secret_token=secret_token,
+                max_connections=getattr(config, 'WEBHOOK_MAX_CONNECTIONS', 40),
+                allowed_updates=Update.ALL_TYPES,
+            )
+        finally:
+            if certificate:
+                certificate.close()
+        logger.info("Бот запущен (вебхук)...")
+        await stop.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 def main():
+    import config
     from config import BOT_TOKEN, CHANNEL_ID, OWNER_ID
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Обработчики не ждут таймеров, а общее состояние меняется без await между проверкой и записью,
+        # поэтому обновления можно обрабатывать параллельно
+        .concurrent_updates(CONCURRENT_UPDATES)
+        # Все вызовы Bot API, кроме getUpdates, считаются по методам
+        .request(InstrumentedRequest(METRICS))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     application.bot_data['CHANNEL_ID'] = CHANNEL_ID
     application.bot_data['OWNER_ID'] = OWNER_ID
     application.bot_data['message_count'] = 0
     
+    # Обработчики и задачи обернуты сбором метрик (время выполнения, ошибки)
+    timed = METRICS.instrument
+    
     # Обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("admin", admin_panel))
+    application.add_handler(CommandHandler("start", timed('start', start)))
+    application.add_handler(CommandHandler("admin", timed('admin_panel', admin_panel)))
+    application.add_handler(CommandHandler("archive", timed('archive_command', archive_command)))
     
     # Обработчики кнопок
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CallbackQueryHandler(timed('button_handler', button_handler)))
     
     # Обработчики сообщений
     application.add_handler(MessageHandler(
         filters.ALL & ~filters.COMMAND, 
-        send_to_channel
+        timed('send_to_channel', send_to_channel)
     ))
     
     # Автоудаление
     job_queue = application.job_queue
     if job_queue:
-        job_queue.run_repeating(auto_delete_messages, interval=60, first=10)
+        job_queue.run_repeating(
+            timed('auto_delete_messages', auto_delete_messages), interval=AUTO_DELETE_INTERVAL, first=10
+        )
+        job_queue.run_repeating(publish_digest, interval=DIGEST_INTERVAL, first=DIGEST_INTERVAL)
+        job_queue.run_repeating(notify_owner, interval=NOTIFY_INTERVAL, first=NOTIFY_INTERVAL)
+        job_queue.run_repeating(archive_messages, interval=ARCHIVE_INTERVAL, first=60)
+        job_queue.run_repeating(reload_settings, interval=SETTINGS_RELOAD_INTERVAL, first=SETTINGS_RELOAD_INTERVAL)
+    
+    if getattr(config, 'UPDATE_MODE', 'polling') == 'webhook':
+        asyncio.run(run_webhook(application, config))
+        return
     
     logger.info("Бот запущен...")
     application.run_polling()
@@ -0,0 +1,223 @@
+import asyncio
+import bisect
+import functools
+import logging
+import time
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def _series(name, labels):
+    """Ключ ряда: значения меток - строки, чтобы ряды с 400 и 'network' сортировались вместе"""
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как в Prometheus"""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя - больше верхней границы
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам: верхняя граница корзины, в которую он попал"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Счетчики, гистограммы и датчики бота в памяти процесса
+
+    Метрика - имя и набор меток (кортеж пар). Датчики (gauge) не хранятся,
+    а вычисляются при выдаче: размер очереди читается в момент запроса.
+    render() выдает текстовый формат Prometheus.
+    """
+
+    def __init__(self, prefix='botg_'):
+        self.prefix = prefix
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = _series(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _series(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, read):
+        """Датчик: read() возвращает число или None, если значение недоступно"""
+        self._gauges[name] = read
+
+    def counter(self, name, **labels):
+        return self._counters.get(_series(name, labels), 0)
+
+    def counters(self, name):
+        """{метки: значение} для всех рядов счетчика"""
+        return {labels: value for (metric, labels), value in self._counters.items() if metric == name}
+
+    def histograms(self, name):
+        return {labels: h for (metric, labels), h in self._histograms.items() if metric == name}
+
+    def gauges(self):
+        values = {}
+        for name, read in self._gauges.items():
+            try:
+                value = read()
+            except Exception as e:
+                logger.warning(f"Датчик {name} не прочитан: {e}")
+                continue
+            if value is not None:
+                values[name] = value
+        return values
+
+    def instrument(self, name, callback):
+        """Обертка обработчика или задачи: время выполнения и число ошибок"""
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except Exception:
+                self.inc('handler_errors_total', handler=name)
+                raise
+            finally:
+                self.observe('handler_seconds', time.perf_counter() - start, handler=name)
+        return wrapper
+
+    def render(self):
+        """Текстовый формат Prometheus (text/plain; version=0.0.4)"""
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {self.prefix}{name} {self._help[name]}")
+            lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+        for name in sorted({metric for metric, _ in self._counters}):
+            header(name, 'counter')
+            for labels, value in sorted(self.counters(name).items()):
+                lines.append(f"{self.prefix}{name}{_labels(labels)} {value}")
+
+        for name in sorted({metric for metric, _ in self._histograms}):
+            header(name, 'histogram')
+            for labels, histogram in sorted(self.histograms(name).items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{self.prefix}{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{self.prefix}{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{self.prefix}{name}_sum{_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{self.prefix}{name}_count{_labels(labels)} {histogram.count}")
+
+        for name, value in sorted(self.gauges().items()):
+            header(name, 'gauge')
+            lines.append(f"{self.prefix}{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы Bot API по методам
+
+    Все запросы бота (кроме getUpdates, у которого свой объект запроса)
+    проходят через do_request, поэтому учитываются и обработчики, и
+    фоновые очереди отправки и удаления.
+    """
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            self.metrics.inc('api_errors_total', method=api_method, code='network')
+            raise
+        finally:
+            self.metrics.observe('api_seconds', time.perf_counter() - start, method=api_method)
+        self.metrics.inc('api_calls_total', method=api_method)
+        if code == 429:
+            self.metrics.inc('api_flood_total', method=api_method)
+        elif code >= 400:
+            self.metrics.inc('api_errors_total', method=api_method, code=code)
+        return code, payload
+
+
+class MetricsServer:
+    """Локальный HTTP-эндпоинт GET /metrics для Prometheus"""
+
+    def __init__(self, metrics, listen='127.0.0.1', port=9108):
+        self.metrics = metrics
+        self.listen = listen
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port)
+        logger.info(f"Метрики: http://{self.listen}:{self._server.sockets[0].getsockname()[1]}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            method, target, _ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+            if method == 'GET' and target.split('?', 1)[0] == '/metrics':
+                status, body = '200 OK', self.metrics.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b''
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
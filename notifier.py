@@ -0,0 +1,22 @@
+class OwnerNotifier:
+    """Сводка для владельца о новых сообщениях
+
+    Сообщения только подсчитываются, а сводка забирается по таймеру,
+    поэтому владелец получает не больше одного уведомления за интервал,
+    сколько бы сообщений ни пришло.
+    """
+
+    def __init__(self):
+        self._count = 0
+        self._users = set()
+
+    def add(self, user_id):
+        self._count += 1
+        self._users.add(user_id)
+
+    def take(self):
+        """Возвращает (сообщений, пользователей) с прошлой сводки и обнуляет их"""
+        summary = (self._count, len(self._users))
+        self._count = 0
+        self._users = set()
+        return summary
@@ -0,0 +1,323 @@
+import asyncio
+import json
+import logging
+
+from telegram import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from ratelimit import TokenBucket, retry_after_seconds
+from storage import AppendLog
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+ALBUM_LIMIT = 10
+DIGEST_SEPARATOR = "\n\n"
+
+INPUT_MEDIA = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+    'document': InputMediaDocument,
+    'audio': InputMediaAudio,
+}
+# Одиночный медиафайл отправляется обычным методом
+SINGLE_MEDIA_METHODS = {
+    'photo': 'send_photo',
+    'video': 'send_video',
+    'document': 'send_document',
+    'audio': 'send_audio',
+}
+
+
+def _album_group(media_type):
+    """Фото и видео можно смешивать в альбоме, документы и аудио - только с такими же"""
+    return 'visual' if media_type in ('photo', 'video') else media_type
+
+
+def telegram_length(text):
+    """Длина в единицах UTF-16 - так лимиты считает Telegram (эмодзи - две единицы)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def length_error(kwargs):
+    """(длина, лимит), если текст или подпись поста длиннее лимита Telegram, иначе None"""
+    for field, limit in (('text', MESSAGE_LIMIT), ('caption', CAPTION_LIMIT)):
+        value = kwargs.get(field)
+        if value and telegram_length(value) > limit:
+            return telegram_length(value), limit
+    return None
+
+
+def split_digest(texts, limit=MESSAGE_LIMIT):
+    """Склеивает тексты в посты не длиннее limit; слишком длинный текст режется"""
+    posts = []
+    current = ""
+    for text in texts:
+        while len(text) > limit:
+            if current:
+                posts.append(current)
+                current = ""
+            posts.append(text[:limit])
+            text = text[limit:]
+        if not text:
+            continue
+        candidate = f"{current}{DIGEST_SEPARATOR}{text}" if current else text
+        if len(candidate) > limit:
+            posts.append(current)
+            candidate = text
+        current = candidate
+    if current:
+        posts.append(current)
+    return posts
+
+
+class ChannelOutbox:
+    """Очередь исходящих постов между приемом сообщений и каналом
+
+    Задание (метод бота + аргументы) сначала записывается в журнал, и только
+    после этого пользователь получает подтверждение. Отправкой занимаются
+    фоновые воркеры: с темпом не больше chat_rate постов в секунду на чат,
+    паузой по retry_after при флуд-контроле и повторами при сетевых ошибках.
+    Недоставленные задания переживают перезапуск. У задания может быть
+    source - (чат, сообщение), из которого сделан пост: on_sent узнает по
+    нему, что исходное сообщение больше не нужно. Если Telegram отклонил
+    пост или попытки кончились, вызывается on_failed - исходное сообщение
+    тоже больше не нужно: пользователь уже получил подтверждение.
+
+    В режиме накопления тексты и медиа не отправляются сразу, а копятся
+    (тоже в журнале) и уходят дайджестом: тексты склеиваются в посты до 4096
+    символов, медиа - альбомами до 10 штук.
+    """
+
+    def __init__(self, chat_rate=20 / 60, chat_burst=3, workers=1, max_attempts=8,
+                 base_backoff=2, max_backoff=300, on_sent=None, on_failed=None,
+                 digest_text_limit=MESSAGE_LIMIT, digest_media_limit=ALBUM_LIMIT):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.digest_text_limit = digest_text_limit
+        self.digest_media_limit = digest_media_limit
+        self.sent = 0
+        self.failed = 0
+        self._pending = {}
+        self._buffer = []
+        self._next_id = 1
+        self._queue = asyncio.Queue()
+        self._buckets = {}
+        self._tasks = []
+        self._log = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    # Журнал
+
+    def open(self, path, **writer_options):
+        """Загружает недоставленные задания из журнала"""
+        for line in AppendLog.read(path):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning(f"Пропущена поврежденная запись {path}")
+                continue
+            if record['op'] == 'add':
+                self._pending[record['id']] = record['job']
+                if record['job']['method'] == 'digest':
+                    self._buffer.append(record['job'])
+            elif record['op'] == 'done':
+                job = self._pending.pop(record['id'], None)
+                if job and job['method'] == 'digest':
+                    self._buffer.remove(job)
+            self._next_id = max(self._next_id, record['id'] + 1)
+
+        self._log = AppendLog(path, **writer_options)
+        self._snapshot()
+        logger.info(f"Очередь отправки загружена: {len(self._pending)} недоставленных")
+
+    def _snapshot(self):
+        self._log.snapshot([self._add_line(job_id, job) for job_id, job in self._pending.items()])
+
+    @staticmethod
+    def _add_line(job_id, job):
+        return json.dumps({'op': 'add', 'id': job_id, 'job': job}, ensure_ascii=False, separators=(',', ':'))
+
+    def _add(self, method, kwargs, source=None):
+        job_id = self._next_id
+        self._next_id += 1
+        job = {'id': job_id, 'method': method, 'kwargs': kwargs, 'attempts': 0}
+        if source:
+            job['source'] = list(source)
+        self._pending[job_id] = job
+        return job, self._log.append(self._add_line(job_id, job))
+
+    def enqueue(self, method, source=None, **kwargs):
+        """Ставит пост в очередь; Future завершится, когда задание записано на диск"""
+        job, written = self._add(method, kwargs, source)
+        if self._tasks:
+            self._queue.put_nowait(job)
+        return written
+
+    # Накопление
+
+    def enqueue_digest(self, chat_id, text=None, media_type=None, media=None, caption=None):
+        """Откладывает текст или медиа до следующего дайджеста"""
+        job, written = self._add('digest', {
+            'chat_id': chat_id,
+            'text': text,
+            'media_type': media_type,
+            'media': media,
+            'caption': caption,
+        })
+        self._buffer.append(job)
+
+        texts = sum(len(item['kwargs']['text'] or '') for item in self._buffer)
+        media_count = sum(1 for item in self._buffer if item['kwargs']['media'])
+        if texts >= self.digest_text_limit or media_count >= self.digest_media_limit:
+            self.flush_digest()
+        return written
+
+    def buffered(self):
+        return len(self._buffer)
+
+    def flush_digest(self):
+        """Превращает накопленное в посты-дайджесты и альбомы"""
+        if not self._buffer:
+            return 0
+        items, self._buffer = self._buffer, []
+
+        jobs = []
+        by_chat = {}
+        for item in items:
+            by_chat.setdefault(item['kwargs']['chat_id'], []).append(item['kwargs'])
+        for chat_id, entries in by_chat.items():
+            texts = [entry['text'] for entry in entries if entry['text']]
+            for post in split_digest(texts):
+                jobs.append(self._add('send_message', {'chat_id': chat_id, 'text': post})[0])
+
+            albums = {}
+            for entry in entries:
+                if entry['media']:
+                    albums.setdefault(_album_group(entry['media_type']), []).append(entry)
+            for group in albums.values():
+                for i in range(0, len(group), ALBUM_LIMIT):
+                    jobs.append(self._album_job(chat_id, group[i:i + ALBUM_LIMIT]))
+
+        # Сначала записываются новые задания, потом закрываются накопленные:
+        # при падении между ними пост может уйти дважды, но не потеряется
+        for item in items:
+            self._finish(item)
+        if self._tasks:
+            for job in jobs:
+                self._queue.put_nowait(job)
+        logger.info(f"Дайджест: {len(items)} сообщений -> {len(jobs)} постов")
+        return len(jobs)
+
+    def _album_job(self, chat_id, entries):
+        if len(entries) == 1:
+            entry = entries[0]
+            method = SINGLE_MEDIA_METHODS[entry['media_type']]
+            kwargs = {'chat_id': chat_id, entry['media_type']: entry['media'], 'caption': entry['caption']}
+            return self._add(method, kwargs)[0]
+        media = [
+            {'type': entry['media_type'], 'media': entry['media'], 'caption': entry['caption']}
+            for entry in entries
+        ]
+        return self._add('send_media_group', {'chat_id': chat_id, 'media': media})[0]
+
+    @staticmethod
+    def _prepare(job):
+        """Аргументы вызова бота: описания медиа превращаются в InputMedia"""
+        kwargs = job['kwargs']
+        if job['method'] == 'send_media_group':
+            media = [INPUT_MEDIA[item['type']](media=item['media'], caption=item['caption']) for item in kwargs['media']]
+            kwargs = {**kwargs, 'media': media}
+        return kwargs
+
+    def _finish(self, job):
+        self._pending.pop(job['id'], None)
+        self._log.append(json.dumps({'op': 'done', 'id': job['id']}, separators=(',', ':')))
+        if self._log.records > 2 * len(self._pending) + 1000:
+            self._snapshot()
+
+    # Отправка
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _deliver(self, bot, job):
+        while True:
+            await self._bucket(job['kwargs'].get('chat_id')).acquire()
+            try:
+                message = await getattr(bot, job['method'])(**self._prepare(job))
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                logger.warning(f"Флуд-контроль при отправке #{job['id']}, пауза {delay:.0f} с")
+                await asyncio.sleep(delay)
+                continue
+            except (BadRequest, Forbidden) as e:
+                self._give_up(job, f"отклонен Telegram: {e}")
+                return
+            except Exception as e:
+                job['attempts'] += 1
+                if job['attempts'] >= self.max_attempts:
+                    self._give_up(job, f"не отправлен за {job['attempts']} попыток: {e}")
+                    return
+                delay = min(self.base_backoff * 2 ** (job['attempts'] - 1), self.max_backoff)
+                logger.warning(f"Ошибка отправки #{job['id']}: {e}, повтор через {delay:.0f} с")
+                await asyncio.sleep(delay)
+                continue
+
+            self.sent += 1
+            self._finish(job)
+            if self.on_sent:
+                try:
+                    self.on_sent(job, message)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки отправленного поста #{job['id']}: {e}")
+            return
+
+    def _give_up(self, job, reason):
+        source = job.get('source')
+        origin = f" (исходное сообщение {source[1]} в чате {source[0]})" if source else ""
+        logger.error(f"Пост #{job['id']} {reason}{origin}")
+        self.failed += 1
+        self._finish(job)
+        if self.on_failed:
+            try:
+                self.on_failed(job)
+            except Exception as e:
+                logger.error(f"Ошибка обработки неотправленного поста #{job['id']}: {e}")
+
+    async def _worker(self, bot):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._deliver(bot, job)
+            finally:
+                self._queue.task_done()
+
+    def start(self, bot):
+        """Запускает воркеры отправки; задания из журнала отправляются первыми"""
+        for job_id in sorted(self._pending):
+            if self._pending[job_id]['method'] != 'digest':
+                self._queue.put_nowait(self._pending[job_id])
+        self._tasks = [asyncio.create_task(self._worker(bot)) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Останавливает воркеры; неотправленное остается в журнале до следующего запуска"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._log:
+            await asyncio.to_thread(self._log.close)
+            self._log = None
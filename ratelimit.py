@@ -0,0 +1,116 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+
+
+def retry_after_seconds(error):
+    """Пауза из ошибки RetryAfter в секундах (retry_after бывает int или timedelta)"""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """Забирает токены, если они есть; не ждет"""
+        self._refill(time.monotonic())
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """Через сколько секунд будет доступно tokens токенов"""
+        self._refill(time.monotonic())
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        """Ждет, пока появятся токены, и забирает их"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+
+class UserRateLimiter:
+    """Антиспам: ведро токенов на пользователя по монотонному времени
+
+    Пользователь может отправить burst сообщений подряд, затем одно сообщение
+    в interval секунд. Пользователи, которые молчат дольше idle_ttl, вытесняются:
+    по умолчанию это время полного наполнения ведра, так что вытеснение ничего
+    не меняет в поведении. max_users ограничивает память при наплыве новых
+    отправителей.
+    """
+
+    def __init__(self, burst=1, interval=10, idle_ttl=None, max_users=100000):
+        self.burst = burst
+        self.interval = interval
+        self.idle_ttl = idle_ttl if idle_ttl is not None else burst * interval
+        self.max_users = max_users
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+        # user_id -> [токены, время последнего обращения]; порядок - по давности обращения
+        self._users = OrderedDict()
+
+    def __len__(self):
+        return len(self._users)
+
+    def _evict(self, now):
+        """Вытесняет давно молчащих пользователей и держит размер не больше max_users"""
+        users = self._users
+        while users:
+            last_seen = next(iter(users.values()))[1]
+            if now - last_seen < self.idle_ttl and len(users) <= self.max_users:
+                break
+            users.popitem(last=False)
+            self.evicted += 1
+
+    def allow(self, user_id):
+        """Разрешает сообщение и списывает токен, если он есть"""
+        now = time.monotonic()
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = [self.burst, now]
+        else:
+            self._users.move_to_end(user_id)
+            state[0] = min(self.burst, state[0] + (now - state[1]) / self.interval)
+            state[1] = now
+        # Текущий пользователь теперь последний, поэтому сам вытеснен не будет
+        self._evict(now)
+
+        if state[0] >= 1:
+            state[0] -= 1
+            self.allowed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self, user_id):
+        """Сколько секунд ждать пользователю до следующего сообщения"""
+        state = self._users.get(user_id)
+        if state is None:
+            return 0.0
+        tokens = min(self.burst, state[0] + (time.monotonic() - state[1]) / self.interval)
+        return max(0.0, (1 - tokens) * self.interval)
+
+    def stats(self):
+        """Размер состояния и счетчики решений"""
+        entry_size = sys.getsizeof([0.0, 0.0]) + 2 * sys.getsizeof(0.0) + sys.getsizeof(2 ** 40)
+        return {
+            'users': len(self._users),
+            'memory_bytes': sys.getsizeof(self._users) + len(self._users) * entry_size,
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'evicted': self.evicted,
+        }
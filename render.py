@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+
+
+class RenderCache:
+    """Кэш готовых экранов админ-панели (текст + клавиатура)
+
+    Экран хранится вместе с версией данных, из которых он построен. Версия
+    пользователя растет при каждом изменении его сообщений, общая версия -
+    при любом изменении. Экран сообщений пользователя зависит только от его
+    версии, списки и счетчики - от общей. Устаревшие записи не удаляются
+    сразу, а перестраиваются при следующем обращении; размер ограничен
+    max_entries (вытесняются давно не открывавшиеся). В режиме redis экраны
+    строятся в потоках, поэтому словари меняются под блокировкой; сам
+    render() выполняется без нее.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def version(self, user_id=None):
+        """Версия данных пользователя или, без user_id, всех данных"""
+        if user_id is None:
+            return self._generation
+        return self._versions.get(str(user_id), 0)
+
+    def invalidate(self, user_id):
+        """Отмечает, что сообщения пользователя изменились"""
+        user_id = str(user_id)
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._generation += 1
+
+    def forget(self, user_id):
+        """Пользователь удален из хранилища"""
+        user_id = str(user_id)
+        with self._lock:
+            self._generation += 1
+            self._versions.pop(user_id, None)
+            # Без версии старые экраны пользователя могли бы снова считаться свежими
+            for key in [key for key in self._entries if len(key) > 1 and key[1] == user_id]:
+                del self._entries[key]
+
+    def get(self, key, version, render):
+        """Возвращает экран из кэша или строит его через render(); None не кэшируется"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = render()
+        with self._lock:
+            if value is None:
+                self._entries.pop(key, None)
+                return None
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        """Размер и счетчики попаданий"""
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,599 @@
+"""Клиент протокола Redis (RESP2) и локальный сервер-заменитель для проверки
+
+    python resp.py --port 6380
+"""
+import argparse
+import asyncio
+import fnmatch
+import logging
+import select
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class RespError(Exception):
+    """Ошибка, которую вернул сервер"""
+
+
+def _encode_command(args):
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, float):
+            data = repr(arg).encode()
+        else:
+            data = str(arg).encode('utf-8')
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b''.join(parts)
+
+
+class RespClient:
+    """Синхронный потокобезопасный клиент Redis
+
+    Одно соединение под замком; пачка команд отправляется за один проход по
+    сети (pipeline), по желанию - внутри MULTI/EXEC. Строки возвращаются
+    как str. Соединение, закрытое сервером во время простоя, открывается
+    заново до отправки. Команды после отправки не повторяются: сервер мог
+    их уже выполнить, а RPUSH, HINCRBY или INCR выполнились бы дважды -
+    ошибка передается вызывающему.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """redis://[:пароль@]хост[:порт][/база]"""
+        parsed = urlparse(url)
+        db = int(parsed.path.lstrip('/') or 0)
+        return cls(parsed.hostname or '127.0.0.1', parsed.port or 6379, db, parsed.password, **kwargs)
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            self._roundtrip(setup)
+
+    def _reset(self):
+        if self._sock:
+            self._file.close()
+            self._sock.close()
+        self._sock = self._file = None
+
+    def close(self):
+        with self._lock:
+            self._reset()
+
+    def _stale(self):
+        """Сервер закрыл простаивающее соединение (между запросами данных от него быть не должно)"""
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Соединение с Redis закрыто")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            return RespError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2].decode('utf-8')
+        if kind == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read() for _ in range(length)]
+        raise ConnectionError(f"Неизвестный ответ Redis: {line!r}")
+
+    def _roundtrip(self, commands):
+        self._sock.sendall(b''.join(_encode_command(command) for command in commands))
+        return [self._read() for _ in commands]
+
+    def pipeline(self, commands, transaction=False):
+        """Выполняет команды одной отправкой; возвращает список ответов"""
+        if not commands:
+            return []
+        if transaction:
+            commands = [('MULTI',), *commands, ('EXEC',)]
+        with self._lock:
+            replies = self._send(commands)
+        if transaction:
+            replies = replies[-1]
+            if replies is None:
+                raise RespError("Транзакция отменена")
+        return self._check(replies)
+
+    @staticmethod
+    def _check(replies):
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def _ensure_connected(self):
+        if self._sock is not None and self._stale():
+            self._reset()
+        # Повторяется только подключение: до него на сервер ничего не ушло
+        for attempt in (1, 2):
+            try:
+                if self._sock is None:
+                    self._connect()
+                return
+            except OSError:
+                self._reset()
+                if attempt == 2:
+                    raise
+
+    def _send(self, commands):
+        """Одна отправка пачки под замком; при ошибке соединение закрывается"""
+        self._ensure_connected()
+        try:
+            return self._roundtrip(commands)
+        except OSError:
+            self._reset()
+            raise
+
+    def watch(self, keys, reads, build, attempts=10):
+        """Чтение и запись с проверкой WATCH: атомарно относительно других клиентов
+
+        Под WATCH по keys выполняются команды reads, build(ответы) возвращает
+        команды записи (или пустой список - писать нечего). Запись уходит в
+        MULTI/EXEC; если кто-то изменил ключи между чтением и EXEC, все
+        повторяется. Возвращает ответы EXEC.
+        """
+        with self._lock:
+            for _ in range(attempts):
+                try:
+                    replies = self._check(self._send([('WATCH', *keys), *reads]))[1:]
+                    writes = build(replies)
+                except Exception:
+                    # Взведенный WATCH на общем соединении отменил бы чужую транзакцию
+                    self._unwatch()
+                    raise
+                if not writes:
+                    self._send([('UNWATCH',)])
+                    return []
+                result = self._send([('MULTI',), *writes, ('EXEC',)])[-1]
+                if isinstance(result, RespError):
+                    # EXECABORT: команда записи отклонена при постановке в очередь
+                    raise result
+                if result is not None:
+                    return self._check(result)
+        raise RespError(f"Транзакция отменена {attempts} раз подряд: ключи меняются")
+
+    def _unwatch(self):
+        if self._sock is None:
+            return  # соединение уже закрыто, WATCH снят вместе с ним
+        try:
+            self._send([('UNWATCH',)])
+        except OSError:
+            pass  # _send закрыл соединение
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+
+# Локальный сервер-заменитель
+
+class _Conflict(Exception):
+    pass
+
+
+class StandInServer:
+    """Redis в памяти на asyncio с подмножеством команд, которые нужны боту
+
+    Команды выполняются целиком в цикле событий, поэтому каждая из них и
+    MULTI/EXEC атомарны, как в настоящем Redis. WATCH следит за версиями
+    ключей: любая команда записи увеличивает версию. Данные не сохраняются.
+    """
+
+    WRITE_COMMANDS = {
+        'DEL', 'PEXPIRE', 'EXPIRE', 'SET', 'INCRBY', 'INCR', 'HSET', 'HSETNX', 'HDEL',
+        'HINCRBY', 'RPUSH', 'LTRIM', 'ZADD', 'ZREM',
+    }
+
+    def __init__(self, host='127.0.0.1', port=6380):
+        self.host = host
+        self.port = port
+        self._data = {}
+        self._expires = {}
+        self._versions = {}
+        self._server = None
+
+    @property
+    def bound_port(self):
+        return self._server.sockets[0].getsockname()[1] if self._server else None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    # Протокол
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.decode('utf-8').split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            header = await reader.readline()
+            length = int(header[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2].decode('utf-8'))
+        return args
+
+    @classmethod
+    def _encode(cls, value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, bool):
+            return b":%d\r\n" % int(value)
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, RespError):
+            return f"-{value}\r\n".encode('utf-8')
+        if isinstance(value, _Status):
+            return f"+{value}\r\n".encode('utf-8')
+        if isinstance(value, (list, tuple)):
+            return b"*%d\r\n" % len(value) + b''.join(cls._encode(item) for item in value)
+        data = str(value).encode('utf-8')
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    async def _serve(self, reader, writer):
+        queued = None
+        watched = {}
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                name = args[0].upper()
+                if name == 'MULTI':
+                    queued = []
+                    reply = OK
+                elif name == 'EXEC':
+                    if queued is None:
+                        reply = RespError("ERR EXEC without MULTI")
+                    elif any(self._versions.get(key, 0) != version for key, version in watched.items()):
+                        reply = None
+                    else:
+                        reply = [self._call(command) for command in queued]
+                    queued = None
+                    watched = {}
+                elif name == 'DISCARD':
+                    queued = None
+                    watched = {}
+                    reply = OK
+                elif name == 'WATCH' and queued is None:
+                    watched.update((key, self._versions.get(key, 0)) for key in args[1:])
+                    reply = OK
+                elif name == 'UNWATCH' and queued is None:
+                    watched = {}
+                    reply = OK
+                elif queued is not None:
+                    queued.append(args)
+                    reply = _Status('QUEUED')
+                else:
+                    reply = self._call(args)
+                writer.write(self._encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _call(self, args):
+        handler = getattr(self, f"cmd_{args[0].lower()}", None)
+        if handler is None:
+            return RespError(f"ERR unknown command '{args[0]}'")
+        try:
+            reply = handler(*args[1:])
+            name = args[0].upper()
+            if name in self.WRITE_COMMANDS:
+                for key in (args[1:] if name == 'DEL' else args[1:2]):
+                    self._versions[key] = self._versions.get(key, 0) + 1
+            elif name == 'FLUSHDB':
+                self._versions = {key: version + 1 for key, version in self._versions.items()}
+            return reply
+        except _Conflict:
+            return RespError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        except (TypeError, ValueError) as e:
+            return RespError(f"ERR {e}")
+
+    # Хранилище
+
+    def _alive(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _get(self, key, kind, create=False):
+        if self._alive(key):
+            value = self._data[key]
+            if not isinstance(value, kind):
+                raise _Conflict()
+            return value
+        if create:
+            value = self._data[key] = kind()
+            return value
+        return None
+
+    def _cleanup(self, key):
+        if key in self._data and not self._data[key] and not isinstance(self._data[key], str):
+            del self._data[key]
+            self._expires.pop(key, None)
+
+    # Общие команды
+
+    def cmd_ping(self, *args):
+        return _Status('PONG')
+
+    def cmd_select(self, db):
+        return OK
+
+    def cmd_auth(self, *args):
+        return OK
+
+    def cmd_flushdb(self, *args):
+        self._data.clear()
+        self._expires.clear()
+        return OK
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                del self._data[key]
+                self._expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._alive(key))
+
+    def cmd_keys(self, pattern):
+        return [key for key in list(self._data) if self._alive(key) and fnmatch.fnmatchcase(key, pattern)]
+
+    def cmd_pexpire(self, key, ms, *flags):
+        if not self._alive(key):
+            return 0
+        flags = {flag.upper() for flag in flags}
+        if 'NX' in flags and key in self._expires:
+            return 0
+        self._expires[key] = time.monotonic() + int(ms) / 1000
+        return 1
+
+    def cmd_expire(self, key, seconds, *flags):
+        return self.cmd_pexpire(key, int(seconds) * 1000, *flags)
+
+    def cmd_pttl(self, key):
+        if not self._alive(key):
+            return -2
+        if key not in self._expires:
+            return -1
+        return max(0, int((self._expires[key] - time.monotonic()) * 1000))
+
+    # Строки
+
+    def cmd_get(self, key):
+        return self._get(key, str)
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        if 'NX' in options and self._alive(key):
+            return None
+        if 'XX' in options and not self._alive(key):
+            return None
+        self._data[key] = value
+        self._expires.pop(key, None)
+        for flag, scale in (('PX', 1), ('EX', 1000)):
+            if flag in options:
+                self._expires[key] = time.monotonic() + int(options[options.index(flag) + 1]) * scale / 1000
+        return OK
+
+    def cmd_incrby(self, key, amount):
+        value = int(self._get(key, str) or 0) + int(amount)
+        self._data[key] = str(value)
+        return value
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, 1)
+
+    # Хэши
+
+    def cmd_hset(self, key, *pairs):
+        table = self._get(key, dict, create=True)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in table
+            table[field] = value
+        return added
+
+    def cmd_hsetnx(self, key, field, value):
+        table = self._get(key, dict, create=True)
+        if field in table:
+            return 0
+        table[field] = value
+        return 1
+
+    def cmd_hget(self, key, field):
+        return (self._get(key, dict) or {}).get(field)
+
+    def cmd_hmget(self, key, *fields):
+        table = self._get(key, dict) or {}
+        return [table.get(field) for field in fields]
+
+    def cmd_hgetall(self, key):
+        table = self._get(key, dict) or {}
+        return [item for pair in table.items() for item in pair]
+
+    def cmd_hdel(self, key, *fields):
+        table = self._get(key, dict) or {}
+        removed = sum(1 for field in fields if table.pop(field, None) is not None)
+        self._cleanup(key)
+        return removed
+
+    def cmd_hincrby(self, key, field, amount):
+        table = self._get(key, dict, create=True)
+        value = int(table.get(field, 0)) + int(amount)
+        table[field] = str(value)
+        return value
+
+    def cmd_hlen(self, key):
+        return len(self._get(key, dict) or {})
+
+    # Списки
+
+    def cmd_rpush(self, key, *values):
+        items = self._get(key, list, create=True)
+        items.extend(values)
+        return len(items)
+
+    @staticmethod
+    def _range(length, start, stop):
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start = max(0, length + start)
+        if stop < 0:
+            stop = length + stop
+        return start, min(stop, length - 1) + 1
+
+    def cmd_lrange(self, key, start, stop):
+        items = self._get(key, list) or []
+        start, stop = self._range(len(items), start, stop)
+        return items[start:stop]
+
+    def cmd_llen(self, key):
+        return len(self._get(key, list) or [])
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self._get(key, list)
+        if items is not None:
+            start, stop = self._range(len(items), start, stop)
+            items[:] = items[start:stop]
+            self._cleanup(key)
+        return OK
+
+    # Упорядоченные множества
+
+    def cmd_zadd(self, key, *pairs):
+        scores = self._get(key, dict, create=True)
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in scores
+            scores[member] = float(score)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        scores = self._get(key, dict) or {}
+        removed = sum(1 for member in members if scores.pop(member, None) is not None)
+        self._cleanup(key)
+        return removed
+
+    def cmd_zscore(self, key, member):
+        score = (self._get(key, dict) or {}).get(member)
+        return None if score is None else repr(score)
+
+    def cmd_zcard(self, key):
+        return len(self._get(key, dict) or {})
+
+    @staticmethod
+    def _bound(value):
+        """Граница диапазона: (число, исключая ли его) - "(5" означает "строго больше/меньше 5"""
+        if value.startswith('('):
+            return float(value[1:]), True
+        return float(value), False
+
+    def _in_range(self, score, low, high):
+        (low, low_open), (high, high_open) = self._bound(low), self._bound(high)
+        return (low < score if low_open else low <= score) and (score < high if high_open else score <= high)
+
+    def _sorted(self, key, reverse=False):
+        scores = self._get(key, dict) or {}
+        return sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=reverse)
+
+    def cmd_zcount(self, key, low, high):
+        return sum(1 for _, score in self._sorted(key) if self._in_range(score, low, high))
+
+    def cmd_zrangebyscore(self, key, low, high, *options):
+        items = [member for member, score in self._sorted(key) if self._in_range(score, low, high)]
+        options = [option.upper() for option in options]
+        if 'LIMIT' in options:
+            i = options.index('LIMIT')
+            offset, count = int(options[i + 1]), int(options[i + 2])
+            items = items[offset:offset + count if count >= 0 else None]
+        return items
+
+    def cmd_zrange(self, key, start, stop):
+        items = self._sorted(key)
+        start, stop = self._range(len(items), start, stop)
+        return [member for member, _ in items[start:stop]]
+
+    def cmd_zrevrange(self, key, start, stop):
+        items = self._sorted(key, reverse=True)
+        start, stop = self._range(len(items), start, stop)
+        return [member for member, _ in items[start:stop]]
+
+
+class _Status(str):
+    """Простой ответ (+OK)"""
+
+
+OK = _Status('OK')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6380)
+    args = parser.parse_args()
+
+    async def serve():
+        server = StandInServer(args.host, args.port)
+        await server.start()
+        logger.info(f"Заменитель Redis слушает {args.host}:{server.bound_port}")
+        await asyncio.Event().wait()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
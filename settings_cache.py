@@ -0,0 +1,161 @@
+import logging
+import os
+import string
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledTemplate:
+    """Шаблон str.format, разобранный один раз
+
+    format() дает тот же результат, что и template.format(**values), но не
+    разбирает строку заново: части шаблона уже разложены на текст и поля.
+    Поддерживаются простые имена полей с преобразованием и форматом
+    ({content}, {content!r:>10}); обращения вида {a.b} и {a[0]} - нет.
+    """
+
+    __slots__ = ('source', '_parts', '_simple')
+
+    def __init__(self, source):
+        self.source = source
+        parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            if literal:
+                parts.append(literal)
+            if field is None:
+                continue
+            if not field.isidentifier():
+                raise ValueError(f"Неподдерживаемое поле шаблона: {{{field}}}")
+            parts.append((field, conversion, spec))
+        self._parts = tuple(parts)
+        # Частый случай "текст {content} текст" собирается одной конкатенацией
+        self._simple = None
+        fields = [i for i, part in enumerate(parts) if isinstance(part, tuple)]
+        if len(fields) == 1 and not parts[fields[0]][1] and not parts[fields[0]][2]:
+            i = fields[0]
+            self._simple = (''.join(parts[:i]), parts[i][0], ''.join(parts[i + 1:]))
+
+    def format(self, **values):
+        if self._simple:
+            prefix, field, suffix = self._simple
+            return prefix + str(values[field]) + suffix
+        out = []
+        for part in self._parts:
+            if not isinstance(part, tuple):
+                out.append(part)
+                continue
+            field, conversion, spec = part
+            value = values[field]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 's':
+                value = str(value)
+            elif conversion == 'a':
+                value = ascii(value)
+            out.append(format(value, spec or ''))
+        return ''.join(out)
+
+
+class SettingsCache(MutableMapping):
+    """Настройки из текстовых файлов с перечитыванием при изменении
+
+    Значения хранятся одним снимком (словарь значений и готовые шаблоны),
+    чтение идет только из памяти. check() вызывается по таймеру: он сверяет
+    stat() файлов с прошлым разом и перечитывает только изменившиеся, после
+    чего подменяет снимок одним присваиванием - читатели видят либо старые,
+    либо новые значения целиком. Ключи без файла (переключатели из
+    админ-панели) живут в памяти и перечитыванием не затрагиваются.
+    """
+
+    def __init__(self, directory, defaults, files, templates=()):
+        self.directory = directory
+        self.defaults = dict(defaults)
+        self.files = tuple(files)
+        self.template_names = tuple(templates)
+        self.reloads = 0
+        self._runtime = {key: value for key, value in self.defaults.items() if key not in self.files}
+        # (значения, шаблоны) - подменяются вместе; до load() - значения по умолчанию
+        self._state = (
+            {name: self.defaults.get(name, "") for name in self.files},
+            {name: CompiledTemplate(self.defaults.get(name, "")) for name in self.template_names},
+        )
+        self._signatures = {}
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.txt")
+
+    def _signature(self, name):
+        """Время изменения, размер и inode файла; None, если файла нет"""
+        try:
+            st = os.stat(self._path(name))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _read(self, name):
+        try:
+            with open(self._path(name), 'r', encoding='utf-8') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return self.defaults.get(name, "")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {name}: {e}")
+            return self._state[0].get(name, self.defaults.get(name, ""))
+
+    def _compile(self, name, value):
+        try:
+            return CompiledTemplate(value)
+        except ValueError as e:
+            # Шаблон с ошибкой не заменяет рабочий
+            logger.error(f"Ошибка в шаблоне {name}: {e}")
+            return self._state[1].get(name) or CompiledTemplate(self.defaults.get(name, ""))
+
+    def load(self):
+        """Читает все файлы настроек"""
+        self._signatures = {}
+        return self._reload(self.files)
+
+    def check(self):
+        """Перечитывает изменившиеся файлы; возвращает имена изменившихся настроек"""
+        changed = [name for name in self.files if self._signature(name) != self._signatures.get(name, 0)]
+        if changed:
+            self._reload(changed)
+            self.reloads += 1
+            logger.info(f"Настройки перечитаны: {', '.join(changed)}")
+        return changed
+
+    def _reload(self, names):
+        values, templates = (dict(part) for part in self._state)
+        for name in names:
+            # Подпись снимается до чтения: запись во время чтения будет замечена в следующий раз
+            self._signatures[name] = self._signature(name)
+            values[name] = self._read(name)
+            if name in self.template_names:
+                templates[name] = self._compile(name, values[name])
+        self._state = (values, templates)
+        return names
+
+    def template(self, name):
+        """Готовый шаблон настройки (см. CompiledTemplate)"""
+        return self._state[1][name]
+
+    def __getitem__(self, key):
+        if key in self._runtime:
+            return self._runtime[key]
+        return self._state[0][key]
+
+    def __setitem__(self, key, value):
+        if key in self.files:
+            raise KeyError(f"{key} задается файлом {self._path(key)}")
+        self._runtime[key] = value
+
+    def __delitem__(self, key):
+        del self._runtime[key]
+
+    def __iter__(self):
+        yield from self._state[0]
+        yield from self._runtime
+
+    def __len__(self):
+        return len(self._state[0]) + len(self._runtime)
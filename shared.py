@@ -0,0 +1,568 @@
+"""Общее состояние для нескольких процессов бота через Redis
+
+Локальные реализации - UserRateLimiter, DeletionScheduler, Deduplicator,
+OwnerNotifier, словарь настроек и хранилища из storage.py - работают внутри одного процесса. Классы ниже
+повторяют их интерфейс поверх Redis (RespClient), чтобы несколько воркеров
+за одним вебхуком делили антиспам, очередь автоудаления, сводку владельцу,
+переключатели настроек и сообщения.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections.abc import MutableMapping
+
+from deletion import DeletionScheduler, PendingDeletion, _parse_chat_id
+from storage import _EPOCH, _MICROSECOND, BackgroundWriter, MessageStore, _cutoff, _done_future, _to_epoch
+
+logger = logging.getLogger(__name__)
+
+
+class SharedRateLimiter:
+    """Антиспам с общим для всех воркеров счетчиком
+
+    Окно burst * interval секунд открывается первым сообщением, в нем
+    разрешено burst сообщений. Счетчик и срок окна ставятся одной
+    транзакцией (INCR + PEXPIRE NX), поэтому гонок между воркерами нет.
+    При burst=1 это ровно "одно сообщение в interval секунд".
+    """
+
+    def __init__(self, client, burst=1, interval=10, prefix='botg:'):
+        self.client = client
+        self.burst = burst
+        self.interval = interval
+        self.prefix = prefix
+        self.allowed = 0
+        self.rejected = 0
+
+    def _key(self, user_id):
+        return f"{self.prefix}spam:{user_id}"
+
+    def allow(self, user_id):
+        key = self._key(user_id)
+        count, _ = self.client.pipeline([
+            ('INCR', key),
+            ('PEXPIRE', key, int(self.burst * self.interval * 1000), 'NX'),
+        ], transaction=True)
+        if count <= self.burst:
+            self.allowed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self, user_id):
+        count, ttl = self.client.pipeline([('GET', self._key(user_id)), ('PTTL', self._key(user_id))])
+        if count is None or int(count) < self.burst or ttl < 0:
+            return 0.0
+        return ttl / 1000
+
+    def stats(self):
+        return {'allowed': self.allowed, 'rejected': self.rejected}
+
+
+class SharedDeduplicator:
+    """Ключи обработанных обновлений в Redis: SET NX PX занимает ключ ровно за одним воркером"""
+
+    def __init__(self, client, prefix='botg:'):
+        self.client = client
+        self.prefix = prefix
+        self.duplicates = 0
+
+    def open(self, path=None, **writer_options):
+        pass
+
+    def close(self):
+        pass
+
+    def seen(self, key):
+        if self.client.execute('EXISTS', f"{self.prefix}dedupe:{key}"):
+            self.duplicates += 1
+            return True
+        return False
+
+    def claim(self, key, ttl):
+        if self.client.execute('SET', f"{self.prefix}dedupe:{key}", 1, 'NX', 'PX', int(ttl * 1000)) is None:
+            self.duplicates += 1
+            return None
+        return _done_future()
+
+    def release(self, key):
+        self.client.execute('DEL', f"{self.prefix}dedupe:{key}")
+
+
+class SharedOwnerNotifier:
+    """Сводка для владельца, общая для воркеров
+
+    Сообщения считаются в хэше Redis, пользователи - полями второго хэша.
+    Сводку забирает только воркер, занявший замок на interval секунд
+    (SET NX PX): владелец получает не больше одного уведомления за
+    интервал, сколько бы воркеров ни было. Чтение и обнуление идут одной
+    транзакцией, поэтому сообщения, пришедшие в этот момент, не теряются.
+    """
+
+    def __init__(self, client, interval, prefix='botg:', worker=None):
+        self.client = client
+        self.interval = interval
+        self.worker = worker or str(os.getpid())
+        self._counts_key = f"{prefix}notify"
+        self._users_key = f"{prefix}notify_users"
+        self._lock_key = f"{prefix}notify_lock"
+
+    def add(self, user_id):
+        self.client.pipeline([
+            ('HINCRBY', self._counts_key, 'messages', 1),
+            ('HSET', self._users_key, str(user_id), 1),
+        ])
+
+    def take(self):
+        """(сообщений, пользователей) с прошлой сводки; (0, 0), если сводку забирает другой воркер"""
+        if self.client.execute('SET', self._lock_key, self.worker, 'NX', 'PX', int(self.interval * 1000)) is None:
+            return 0, 0
+        messages, users, _ = self.client.pipeline([
+            ('HGET', self._counts_key, 'messages'),
+            ('HLEN', self._users_key),
+            ('DEL', self._counts_key, self._users_key),
+        ], transaction=True)
+        return int(messages or 0), users
+
+
+class SharedDeletionScheduler(DeletionScheduler):
+    """Очередь автоудаления в Redis: упорядоченное множество по сроку
+
+    Удаление забирает просроченные записи через ZREM - запись достается
+    только тому воркеру, у которого ZREM вернул 1, поэтому сообщение не
+    удаляется дважды. Журнал на диске не нужен: очередь живет в Redis.
+
+    schedule() и отметки о попытках вызываются из цикла событий, поэтому
+    после open() их команды уходят через BackgroundWriter; разбор
+    просроченных в run() идет в потоке. len() - размер очереди на момент
+    последнего разбора: датчик метрик не обращается к Redis.
+    """
+
+    def __init__(self, client, prefix='botg:', claim_batch=1000, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+        self.claim_batch = claim_batch
+        self._queue_key = f"{prefix}deletions"
+        self._attempts_key = f"{prefix}deletion_attempts"
+        self._size = 0
+        self._writer = None
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _member(entry):
+        return f"{entry.chat_id}\t{entry.message_id}"
+
+    def open(self, path=None, **writer_options):
+        overdue, self._size = self.client.pipeline([
+            ('ZCOUNT', self._queue_key, '-inf', time.time()),
+            ('ZCARD', self._queue_key),
+        ])
+        self._writer = BackgroundWriter(self._write_commands, name='redis-deletions', **writer_options)
+        logger.info(f"Общая очередь автоудаления: {self._size} сообщений, просрочено {overdue}")
+        return overdue
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    def _write_commands(self, records):
+        self.client.pipeline([command for commands in records for command in commands])
+
+    def _send(self, commands):
+        if self._writer:
+            self._writer.submit(commands)
+        else:
+            self.client.pipeline(commands)
+
+    def _push(self, entry):
+        commands = [('ZADD', self._queue_key, entry.deadline, self._member(entry))]
+        if entry.attempts:
+            commands.append(('HSET', self._attempts_key, self._member(entry), entry.attempts))
+        self._send(commands)
+
+    def _log_added(self, entry):
+        pass
+
+    def _log_done(self, entry):
+        if entry.attempts:
+            self._send([('HDEL', self._attempts_key, self._member(entry))])
+
+    async def _take_expired(self):
+        return await asyncio.to_thread(self.pop_expired)
+
+    def pop_expired(self, now=None):
+        now = time.time() if now is None else now
+        expired = []
+        while True:
+            members = self.client.execute(
+                'ZRANGEBYSCORE', self._queue_key, '-inf', now, 'LIMIT', 0, self.claim_batch
+            )
+            if not members:
+                break
+            claimed = self.client.pipeline([('ZREM', self._queue_key, member) for member in members])
+            mine = [member for member, won in zip(members, claimed) if won]
+            attempts = self.client.execute('HMGET', self._attempts_key, *mine) if mine else []
+            for member, tries in zip(mine, attempts):
+                chat_id, message_id = member.split('\t')
+                expired.append(PendingDeletion(_parse_chat_id(chat_id), int(message_id), now, int(tries or 0)))
+            if len(members) < self.claim_batch:
+                break
+        self._size = self.client.execute('ZCARD', self._queue_key)
+        return expired
+
+
+class SharedSettings(MutableMapping):
+    """Настройки, часть которых общая для воркеров
+
+    Ключи из shared хранятся в хэше Redis. Чтение идет только из памяти:
+    refresh() перечитывает хэш и вызывается по таймеру в потоке, поэтому
+    изменение в одном воркере остальные видят не позже следующего вызова.
+    Остальные настройки - тексты из папки Settings - у каждого воркера свои.
+    """
+
+    def __init__(self, client, local, shared, prefix='botg:'):
+        self.client = client
+        self.shared = set(shared)
+        self._key = f"{prefix}settings"
+        self._local = local  # локальные настройки могут перечитываться из файлов
+        # Первый воркер задает значения по умолчанию, остальные их читают
+        self.client.pipeline([
+            ('HSETNX', self._key, key, json.dumps(self._local[key])) for key in self.shared if key in self._local
+        ])
+        self.refresh()
+
+    def refresh(self):
+        """Перечитывает общие ключи из Redis"""
+        values = self.client.execute('HGETALL', self._key)
+        for key, value in zip(values[::2], values[1::2]):
+            if key in self.shared:
+                self._local[key] = json.loads(value)
+
+    def __getitem__(self, key):
+        return self._local[key]
+
+    def __setitem__(self, key, value):
+        self._local[key] = value
+        if key in self.shared:
+            self.client.execute('HSET', self._key, key, json.dumps(value))
+
+    def __delitem__(self, key):
+        del self._local[key]
+        if key in self.shared:
+            self.client.execute('HDEL', self._key, key)
+
+    def __iter__(self):
+        return iter(self._local)
+
+    def __len__(self):
+        return len(self._local)
+
+
+class RedisMessageStore(MessageStore):
+    """Хранилище сообщений в Redis, общее для воркеров
+
+    Сообщения пользователя - список JSON, активность - упорядоченное
+    множество, счетчики - хэши. Запись идет через BackgroundWriter: группа
+    изменений уходит одной транзакцией. "Просмотрено" хранится как граница
+    viewed_upto: сообщения до нее считаются просмотренными, поэтому пометка
+    не переписывает список. Время всех сообщений лежит в общем упорядоченном
+    множестве times (элемент - пользователь и хэш строки сообщения): сроки
+    хранения планируются по нему, не читая сами сообщения.
+    """
+
+    def __init__(self, client, prefix='botg:', legacy_path=None, **writer_options):
+        self.client = client
+        self.prefix = prefix
+        self._activity_key = f"{prefix}activity"
+        self._meta_key = f"{prefix}meta"
+        self._unread_key = f"{prefix}unread"
+        self._upto_key = f"{prefix}viewed_upto"
+        self._stats_key = f"{prefix}stats"
+        self._times_key = f"{prefix}times"
+
+        if legacy_path and os.path.exists(legacy_path) and not client.execute('EXISTS', self._stats_key):
+            self._migrate(legacy_path)
+        self._index_times()
+        self._writer = BackgroundWriter(self._write_records, name='redis-writer', **writer_options)
+
+    def _messages_key(self, user_id):
+        return f"{self.prefix}msgs:{user_id}"
+
+    def _migrate(self, legacy_path):
+        """Одноразовый импорт старого stored_messages.json"""
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка импорта {legacy_path}: {e}")
+            return
+        commands = [('HSET', self._stats_key, 'total', 0, 'unread', 0)]
+        for user_id, messages in data.items():
+            for message in messages:
+                commands.extend(self._add_commands(str(user_id), message))
+        self.client.pipeline(commands, transaction=True)
+        logger.info(f"Импортировано {sum(len(m) for m in data.values())} сообщений из {legacy_path} в Redis")
+
+    def _index_times(self):
+        """Одноразово строит times для сообщений, записанных до его появления"""
+        total, indexed = self.client.pipeline([('HGET', self._stats_key, 'total'), ('ZCARD', self._times_key)])
+        if not int(total or 0) or indexed:
+            return
+        for user_id in self.client.execute('ZRANGE', self._activity_key, 0, -1):
+            lines = self.client.execute('LRANGE', self._messages_key(user_id), 0, -1)
+            if lines:
+                self.client.execute('ZADD', self._times_key, *(
+                    value for line in lines for value in self._time_entry(user_id, line)
+                ))
+        logger.info(f"Построен индекс времени сообщений: {total} сообщений")
+
+    @staticmethod
+    def _time_member(user_id, line):
+        return f"{user_id}\t{hashlib.sha1(line.encode('utf-8')).hexdigest()[:16]}"
+
+    def _time_entry(self, user_id, line):
+        """(score, элемент) для times; неразборчивое время - самое старое, как в plan_expired"""
+        epoch = _to_epoch(json.loads(line).get('timestamp'))
+        return (epoch / 1e6 if epoch is not None else 0), self._time_member(user_id, line)
+
+    def _add_commands(self, user_id, message):
+        try:
+            score = _to_epoch(message.get('timestamp')) / 1e6
+        except TypeError:
+            score = time.time()
+        line = json.dumps(message, ensure_ascii=False, separators=(',', ':'))
+        commands = [
+            ('RPUSH', self._messages_key(user_id), line),
+            ('ZADD', self._times_key, *self._time_entry(user_id, line)),
+            ('ZADD', self._activity_key, score, user_id),
+            ('HSETNX', self._meta_key, user_id, json.dumps([message.get('full_name'), message.get('username')])),
+            ('HINCRBY', self._stats_key, 'total', 1),
+        ]
+        if not message.get('viewed', False):
+            commands.append(('HINCRBY', self._unread_key, user_id, 1))
+            commands.append(('HINCRBY', self._stats_key, 'unread', 1))
+        return commands
+
+    # Запись (поток записи)
+
+    def _write_records(self, records):
+        commands = []
+        for op, args in records:
+            if op == 'add':
+                commands.extend(args)
+                continue
+            # Пометка и удаление читают текущее состояние: сначала отправляем накопленное
+            self.client.pipeline(commands, transaction=True)
+            commands = []
+            if op == 'viewed':
+                self._apply_viewed(*args)
+            elif op == 'drop':
+                self._apply_drop(*args)
+        self.client.pipeline(commands, transaction=True)
+
+    def _apply_viewed(self, user_id):
+        def build(replies):
+            total, unread = replies
+            unread = int(unread or 0)
+            if not unread:
+                return []
+            return [
+                ('HINCRBY', self._unread_key, user_id, -unread),
+                ('HINCRBY', self._stats_key, 'unread', -unread),
+                ('HSET', self._upto_key, user_id, total),
+            ]
+
+        # Под WATCH: если другой воркер тем временем добавил сообщение или тоже пометил
+        # их просмотренными, запись повторится с новыми значениями и счетчики не уйдут в минус.
+        # Счетчик пользователя меняется только вместе с его списком или границей просмотра,
+        # поэтому общий хэш unread не отслеживается (его меняет каждое новое сообщение)
+        self.client.watch(
+            [self._messages_key(user_id), self._upto_key],
+            [('LLEN', self._messages_key(user_id)), ('HGET', self._unread_key, user_id)],
+            build,
+        )
+
+    def _apply_drop(self, user_id, count):
+        key = self._messages_key(user_id)
+
+        def build(replies):
+            head, upto = replies
+            upto = int(upto or 0)
+            dropped = len(head)
+            if not dropped:
+                return []
+            unread = sum(
+                1 for i, line in enumerate(head) if i >= upto and not json.loads(line).get('viewed', False)
+            )
+            return [
+                ('LTRIM', key, dropped, -1),
+                ('ZREM', self._times_key, *(self._time_member(user_id, line) for line in head)),
+                ('HSET', self._upto_key, user_id, max(0, upto - dropped)),
+                ('HINCRBY', self._unread_key, user_id, -unread),
+                ('HINCRBY', self._stats_key, 'unread', -unread),
+                ('HINCRBY', self._stats_key, 'total', -dropped),
+                ('LLEN', key),
+            ]
+
+        # Граница просмотра могла сдвинуться в другом воркере между чтением и записью
+        result = self.client.watch(
+            [key, self._upto_key],
+            [('LRANGE', key, 0, count - 1), ('HGET', self._upto_key, user_id)],
+            build,
+        )
+        remaining = result[-1] if result else None
+        if remaining == 0:
+            self.client.pipeline([
+                ('ZREM', self._activity_key, user_id),
+                ('HDEL', self._meta_key, user_id),
+                ('HDEL', self._unread_key, user_id),
+                ('HDEL', self._upto_key, user_id),
+            ], transaction=True)
+
+    def add_message(self, user_id, message):
+        return self._writer.submit(('add', self._add_commands(str(user_id), dict(message))))
+
+    def mark_viewed(self, user_id):
+        return self._writer.submit(('viewed', (str(user_id),)))
+
+    # Чтение
+
+    @staticmethod
+    def _decode(lines, start, upto):
+        messages = []
+        for i, line in enumerate(lines, start):
+            message = json.loads(line)
+            if i < upto:
+                message['viewed'] = True
+            messages.append(message)
+        return messages
+
+    def user_counts(self, user_id):
+        user_id = str(user_id)
+        total, unread = self.client.pipeline([
+            ('LLEN', self._messages_key(user_id)),
+            ('HGET', self._unread_key, user_id),
+        ])
+        return total, int(unread or 0)
+
+    def get_user_messages(self, user_id):
+        messages, _ = self.user_messages_page(user_id, 0, -1)
+        return messages
+
+    def user_messages_page(self, user_id, offset, limit):
+        user_id = str(user_id)
+        stop = offset + limit - 1 if limit >= 0 else -1
+        lines, total, upto = self.client.pipeline([
+            ('LRANGE', self._messages_key(user_id), offset, stop),
+            ('LLEN', self._messages_key(user_id)),
+            ('HGET', self._upto_key, user_id),
+        ])
+        return self._decode(lines, offset, int(upto or 0)), total
+
+    def _users_info(self, user_ids):
+        commands = []
+        for user_id in user_ids:
+            commands += [
+                ('HGET', self._meta_key, user_id),
+                ('LLEN', self._messages_key(user_id)),
+                ('HGET', self._unread_key, user_id),
+            ]
+        replies = self.client.pipeline(commands)
+        users = []
+        for i, user_id in enumerate(user_ids):
+            meta, total, unread = replies[3 * i:3 * i + 3]
+            full_name, username = json.loads(meta) if meta else (None, None)
+            users.append({
+                'user_id': user_id,
+                'full_name': full_name or 'Неизвестный',
+                'username': username or 'без @username',
+                'total': total,
+                'unread': int(unread or 0),
+            })
+        return users
+
+    def _user_info(self, user_id):
+        return self._users_info([user_id])[0]
+
+    def list_users(self):
+        return self._users_info(self.client.execute('ZREVRANGE', self._activity_key, 0, -1))
+
+    def users_page(self, cursor=None, limit=10):
+        # Курсор здесь - смещение в множестве активности
+        offset = cursor or 0
+        user_ids = self.client.execute('ZREVRANGE', self._activity_key, offset, offset + limit)
+        next_cursor = offset + limit if len(user_ids) > limit else None
+        prev_cursor = None if not offset else (offset - limit if offset > limit else -1)
+        return self._users_info(user_ids[:limit]), next_cursor, prev_cursor
+
+    def counts(self):
+        unread, total = self.client.execute('HMGET', self._stats_key, 'unread', 'total')
+        return int(unread or 0), int(total or 0)
+
+    def export(self):
+        return {
+            user_id: self.get_user_messages(user_id)
+            for user_id in self.client.execute('ZRANGE', self._activity_key, 0, -1)
+        }
+
+    # Срок хранения
+
+    def expired(self, max_age=None, max_per_user=None, max_total=None, now=None, batch=1000):
+        """План как у plan_expired, но по times: читаются только уходящие сообщения"""
+        drops = {}
+        if max_age:
+            cutoff = (_cutoff(max_age, now) - _EPOCH) / _MICROSECOND / 1e6
+            for member in self.client.execute('ZRANGEBYSCORE', self._times_key, '-inf', f"({cutoff}"):
+                user_id = member.split('\t', 1)[0]
+                drops[user_id] = drops.get(user_id, 0) + 1
+        if max_per_user:
+            user_ids = self.client.execute('ZRANGE', self._activity_key, 0, -1)
+            totals = self.client.pipeline([('LLEN', self._messages_key(user_id)) for user_id in user_ids])
+            for user_id, total in zip(user_ids, totals):
+                if total > max_per_user:
+                    drops[user_id] = max(drops.get(user_id, 0), total - max_per_user)
+
+        excess = self.client.execute('ZCARD', self._times_key) - sum(drops.values()) - max_total if max_total else 0
+        # Общий проход от старых к новым; уже выбранные выше префиксы пользователей пропускаются
+        planned = dict(drops)
+        seen = {}
+        offset = 0
+        while excess > 0:
+            members = self.client.execute('ZRANGE', self._times_key, offset, offset + batch - 1)
+            if not members:
+                break
+            offset += len(members)
+            for member in members:
+                user_id = member.split('\t', 1)[0]
+                seen[user_id] = seen.get(user_id, 0) + 1
+                if seen[user_id] <= planned.get(user_id, 0):
+                    continue
+                drops[user_id] = drops.get(user_id, 0) + 1
+                excess -= 1
+                if excess <= 0:
+                    break
+        return drops
+
+    def oldest_messages(self, user_id, count):
+        messages, _ = self.user_messages_page(user_id, 0, count)
+        return messages
+
+    def drop_oldest(self, user_id, count):
+        if count <= 0:
+            return _done_future()
+        return self._writer.submit(('drop', (str(user_id), count)))
+
+    def pending_writes(self):
+        return self._writer.pending()
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
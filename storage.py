@@ -0,0 +1,1152 @@
+import bisect
+import heapq
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+_BARRIER = object()
+_STOP = object()
+
+
+def _encode(record):
+    """Кодирует запись журнала в одну строку JSON"""
+    return (json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str) + '\n').encode('utf-8')
+
+
+FSYNC_POLICIES = ('batch', 'none')
+
+
+class BackgroundWriter:
+    """Отдельный поток записи на диск с ограниченной очередью и групповой фиксацией
+
+    Записи, пришедшие в пределах window секунд (или пока их меньше max_batch),
+    пишутся одной операцией. При fsync='batch' после каждой группы вызывается
+    sync(), и Future записей завершаются только после него; при fsync='none'
+    запись считается сделанной, как только данные переданы ОС.
+    """
+
+    def __init__(self, write_batch, sync=None, name='storage-writer', maxsize=10000,
+                 window=0.2, max_batch=500, fsync='batch'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Неизвестная политика fsync: {fsync}")
+        self._write_batch = write_batch
+        self._sync = sync
+        self.window = window
+        self.max_batch = max_batch
+        self.fsync = fsync
+        self.batches = 0
+        self.records = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, record):
+        """Ставит запись в очередь; Future завершится, когда запись окажется на диске"""
+        future = Future()
+        item = (record, future)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # Очередь ограничена: при отставании диска вызывающий код притормаживается, а не копит память
+            logger.warning(f"Очередь записи {self._thread.name} переполнена, ожидание диска")
+            self._queue.put(item)
+        return future
+
+    def pending(self):
+        """Количество записей, ожидающих записи"""
+        return self._queue.qsize()
+
+    def _collect(self):
+        """Собирает группу записей: ждет не дольше window после первой"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch and batch[-1][0] not in (_BARRIER, _STOP):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            records = [record for record, _ in batch if record is not _BARRIER and record is not _STOP]
+            try:
+                if records:
+                    self._write_batch(records)
+                    if self.fsync == 'batch' and self._sync:
+                        self._sync()
+                    self.batches += 1
+                    self.records += len(records)
+                for _, future in batch:
+                    future.set_result(None)
+            except Exception as e:
+                logger.error(f"Ошибка записи на диск ({self._thread.name}): {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+            if batch[-1][0] is _STOP:
+                return
+
+    def flush(self):
+        """Ждет, пока будет записано все, что уже стоит в очереди"""
+        self.submit(_BARRIER).result()
+
+    def close(self):
+        """Дописывает очередь и останавливает поток"""
+        self.submit(_STOP).result()
+        self._thread.join()
+
+
+class AppendLog:
+    """Текстовый журнал на дозапись через BackgroundWriter
+
+    append() дописывает строку, snapshot() целиком заменяет файл списком строк;
+    оба выполняются в потоке записи в порядке вызова.
+    """
+
+    def __init__(self, path, **writer_options):
+        self.path = path
+        self.records = 0
+        self._file = open(path, 'a', encoding='utf-8')
+        self._writer = BackgroundWriter(
+            self._write, sync=self._sync, name=f'log-{os.path.basename(path)}', **writer_options
+        )
+
+    @staticmethod
+    def read(path):
+        """Строки существующего журнала (без перевода строки)"""
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+
+    def append(self, line):
+        """Дописывает строку; Future завершится после записи"""
+        self.records += 1
+        return self._writer.submit(line + '\n')
+
+    def snapshot(self, lines):
+        """Заменяет содержимое журнала"""
+        lines = [line + '\n' for line in lines]
+        self.records = len(lines)
+        return self._writer.submit(lines)
+
+    def pending(self):
+        return self._writer.pending()
+
+    def _write(self, records):
+        for record in records:
+            if isinstance(record, list):
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.writelines(record)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._file.close()
+                os.replace(tmp_path, self.path)
+                self._file = open(self.path, 'a', encoding='utf-8')
+            else:
+                self._file.write(record)
+        self._file.flush()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._writer.close()
+        self._file.close()
+
+
+class MessageCounters:
+    """Счетчики сообщений (всего/новых) глобально и по пользователям"""
+
+    def __init__(self):
+        self.total = 0
+        self.unread = 0
+        self._users = {}  # user_id -> [всего, новых]
+
+    def added(self, user_id, viewed=False):
+        counters = self._users.setdefault(user_id, [0, 0])
+        counters[0] += 1
+        self.total += 1
+        if not viewed:
+            counters[1] += 1
+            self.unread += 1
+
+    def load_user(self, user_id, total, unread):
+        """Задает счетчики пользователя при загрузке"""
+        self._users[user_id] = [total, unread]
+        self.total += total
+        self.unread += unread
+
+    def removed(self, user_id, total, unread):
+        """Учитывает удаление total сообщений пользователя, из них unread новых"""
+        counters = self._users.get(user_id)
+        if not counters:
+            return
+        counters[0] -= total
+        counters[1] -= unread
+        self.total -= total
+        self.unread -= unread
+        if counters[0] <= 0:
+            del self._users[user_id]
+
+    def viewed(self, user_id):
+        """Отмечает все новые сообщения пользователя прочитанными, возвращает их число"""
+        counters = self._users.get(user_id)
+        if not counters or not counters[1]:
+            return 0
+        changed = counters[1]
+        counters[1] = 0
+        self.unread -= changed
+        return changed
+
+    def user(self, user_id):
+        """Возвращает (всего, новых) для пользователя"""
+        total, unread = self._users.get(user_id, (0, 0))
+        return total, unread
+
+    def users(self):
+        return self._users.keys()
+
+
+# Поля сообщения в формате stored_messages.json
+MESSAGE_FIELDS = ('timestamp', 'type', 'content', 'full_name', 'username', 'viewed')
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _to_epoch(timestamp):
+    """ISO-время без часового пояса -> микросекунды от 1970-01-01 (None, если не разобрать)
+
+    Время в сообщениях локальное (datetime.now()), поэтому переводится как есть,
+    без учета зоны: обратное преобразование дает ту же строку.
+    """
+    try:
+        moment = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is not None:
+        return None
+    return (moment - _EPOCH) // _MICROSECOND
+
+
+def _cutoff(max_age, now=None):
+    """Момент, сообщения старше которого выходят за срок хранения"""
+    return (now or datetime.now()) - timedelta(seconds=max_age)
+
+
+def _from_epoch(value):
+    return (_EPOCH + timedelta(microseconds=value)).isoformat()
+
+
+def plan_expired(timestamps, max_age=None, max_per_user=None, max_total=None, now=None):
+    """Сколько самых старых сообщений каждого пользователя выходит за сроки хранения
+
+    timestamps - {user_id: время сообщений (микросекунды от 1970) по возрастанию}.
+    """
+    cutoff = (_cutoff(max_age, now) - _EPOCH) // _MICROSECOND if max_age else None
+    drops = {}
+    total = 0
+    for user_id, times in timestamps.items():
+        total += len(times)
+        # Сообщения пользователя добавляются по времени, поэтому старые - префикс
+        count = bisect.bisect_left(times, cutoff) if cutoff is not None else 0
+        if max_per_user:
+            count = max(count, len(times) - max_per_user)
+        if count:
+            drops[user_id] = count
+
+    excess = total - sum(drops.values()) - max_total if max_total else 0
+    if excess > 0:
+        # Слияние пользователей по времени самого старого оставшегося сообщения
+        heap = [
+            (times[drops.get(user_id, 0)], user_id)
+            for user_id, times in timestamps.items()
+            if drops.get(user_id, 0) < len(times)
+        ]
+        heapq.heapify(heap)
+        while excess > 0 and heap:
+            _, user_id = heapq.heappop(heap)
+            drops[user_id] = drops.get(user_id, 0) + 1
+            excess -= 1
+            times = timestamps[user_id]
+            if drops[user_id] < len(times):
+                heapq.heappush(heap, (times[drops[user_id]], user_id))
+    return drops
+
+
+class UserMessages:
+    """Сообщения одного пользователя по столбцам
+
+    Вместо словаря на сообщение: время - массив int64 (микросекунды), тип -
+    интернированная строка, флаг "просмотрено" - бит в bytearray, а имя и
+    username хранятся один раз на пользователя. Все, что не укладывается в
+    эту схему (другое имя в отдельном сообщении, неразборчивое время, лишние
+    поля), лежит в редком словаре extras, так что message(i) восстанавливает
+    исходный словарь без потерь.
+    """
+
+    __slots__ = ('full_name', 'username', 'timestamps', 'types', 'contents', 'viewed', 'extras')
+
+    def __init__(self):
+        self.full_name = None
+        self.username = None
+        self.timestamps = array('q')
+        self.types = []
+        self.contents = []
+        self.viewed = bytearray()
+        self.extras = None
+
+    def __len__(self):
+        return len(self.contents)
+
+    def __iter__(self):
+        return (self.message(i) for i in range(len(self.contents)))
+
+    def append(self, message):
+        i = len(self.contents)
+        if not i:
+            self.full_name = message.get('full_name')
+            self.username = message.get('username')
+
+        extra = {key: value for key, value in message.items() if key not in MESSAGE_FIELDS}
+        if message.get('full_name') != self.full_name:
+            extra['full_name'] = message.get('full_name')
+        if message.get('username') != self.username:
+            extra['username'] = message.get('username')
+        epoch = _to_epoch(message.get('timestamp'))
+        if epoch is None:
+            extra['timestamp'] = message.get('timestamp')
+            epoch = 0
+
+        self.timestamps.append(epoch)
+        self.types.append(sys.intern(message.get('type') or 'text'))
+        self.contents.append(message.get('content'))
+        if not i & 7:
+            self.viewed.append(0)
+        if message.get('viewed', False):
+            self.viewed[i >> 3] |= 1 << (i & 7)
+        if extra:
+            if self.extras is None:
+                self.extras = {}
+            self.extras[i] = extra
+
+    def is_viewed(self, i):
+        return bool(self.viewed[i >> 3] >> (i & 7) & 1)
+
+    def unread(self):
+        return len(self.contents) - bin(int.from_bytes(self.viewed, 'little')).count('1')
+
+    def mark_viewed(self):
+        """Помечает все сообщения просмотренными (биты за последним сообщением остаются нулями)"""
+        count = len(self.contents)
+        viewed = bytearray(b'\xff') * (count >> 3)
+        if count & 7:
+            viewed.append((1 << (count & 7)) - 1)
+        self.viewed = viewed
+
+    def drop(self, count):
+        """Удаляет count самых старых сообщений; возвращает, сколько из них было непросмотрено"""
+        rest = len(self.contents) - count
+        bits = int.from_bytes(self.viewed, 'little')
+        unread = count - bin(bits & ((1 << count) - 1)).count('1')
+        self.viewed = bytearray((bits >> count).to_bytes((rest + 7) >> 3, 'little'))
+        del self.timestamps[:count]
+        del self.types[:count]
+        del self.contents[:count]
+        if self.extras:
+            self.extras = {i - count: extra for i, extra in self.extras.items() if i >= count} or None
+        return unread
+
+    def last_timestamp(self):
+        return self.timestamps[-1] if self.timestamps else 0
+
+    def message(self, i):
+        """Сообщение в формате stored_messages.json"""
+        message = {
+            'timestamp': _from_epoch(self.timestamps[i]),
+            'type': self.types[i],
+            'content': self.contents[i],
+            'full_name': self.full_name,
+            'username': self.username,
+            'viewed': self.is_viewed(i),
+        }
+        if self.extras and i in self.extras:
+            message.update(self.extras[i])
+        return message
+
+    def slice(self, start, stop):
+        return [self.message(i) for i in range(start, min(stop, len(self.contents)))]
+
+    def copy(self):
+        """Независимая копия (для снимка при сжатии журнала)"""
+        other = UserMessages()
+        other.full_name = self.full_name
+        other.username = self.username
+        other.timestamps = array('q', self.timestamps)
+        other.types = list(self.types)
+        other.contents = list(self.contents)
+        other.viewed = bytearray(self.viewed)
+        other.extras = dict(self.extras) if self.extras else None
+        return other
+
+
+class ActivityIndex:
+    """Пользователи в порядке последней активности с постраничным курсором
+
+    Активность дописывается в конец списка, старая позиция пользователя
+    становится "мертвой" и пропускается при листании. Курсор - позиция в
+    списке, поэтому страница строится за O(размер страницы + мертвые записи),
+    а список изредка пересобирается, когда мертвых записей становится много.
+    """
+
+    def __init__(self):
+        self._log = []
+        self._pos = {}
+
+    def __len__(self):
+        return len(self._pos)
+
+    def touch(self, user_id):
+        self._pos[user_id] = len(self._log)
+        self._log.append(user_id)
+        if len(self._log) > 2 * len(self._pos) + 1000:
+            self._rebuild()
+
+    def remove(self, user_id):
+        self._pos.pop(user_id, None)
+
+    def _rebuild(self):
+        self._log = sorted(self._pos, key=self._pos.get)
+        self._pos = {user_id: i for i, user_id in enumerate(self._log)}
+
+    def _live(self, i):
+        return self._pos.get(self._log[i]) == i
+
+    def newest(self):
+        """Все пользователи, начиная с самых активных"""
+        return [self._log[i] for i in range(len(self._log) - 1, -1, -1) if self._live(i)]
+
+    def page(self, cursor=None, limit=10):
+        """Возвращает (пользователи, курсор следующей страницы, курсор предыдущей)"""
+        start = len(self._log) if cursor is None else max(0, min(cursor, len(self._log)))
+        found = []
+        i = start - 1
+        while i >= 0 and len(found) < limit:
+            if self._live(i):
+                found.append(i)
+            i -= 1
+
+        next_cursor = None
+        while i >= 0:
+            if self._live(i):
+                next_cursor = found[-1]
+                break
+            i -= 1
+
+        prev_cursor = None
+        seen = 0
+        j = found[0] + 1 if found else start
+        while j < len(self._log) and seen < limit:
+            if self._live(j):
+                seen += 1
+                prev_cursor = j + 1
+            j += 1
+        # Предыдущая страница - самая новая: курсор не нужен
+        if prev_cursor is not None and prev_cursor >= len(self._log):
+            prev_cursor = -1
+
+        return [self._log[i] for i in found], next_cursor, prev_cursor
+
+
+def _done_future(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class MessageStore:
+    """Базовый интерфейс хранилища сообщений"""
+
+    def add_message(self, user_id, message):
+        """Добавляет сообщение пользователя; возвращает Future записи на диск"""
+        raise NotImplementedError
+
+    def mark_viewed(self, user_id):
+        """Помечает все сообщения пользователя просмотренными; возвращает Future записи на диск"""
+        raise NotImplementedError
+
+    def user_counts(self, user_id):
+        """Возвращает (всего, непрочитанных) сообщений пользователя"""
+        return self._counters.user(str(user_id))
+
+    def get_user_messages(self, user_id):
+        """Возвращает список сообщений пользователя"""
+        raise NotImplementedError
+
+    def user_messages_page(self, user_id, offset, limit):
+        """Возвращает (сообщения пользователя начиная с offset, всего сообщений)"""
+        raise NotImplementedError
+
+    def _user_info(self, user_id):
+        """Имя, username и счетчики пользователя"""
+        raise NotImplementedError
+
+    def list_users(self):
+        """Возвращает пользователей со счетчиками сообщений, самые активные первыми"""
+        return [self._user_info(user_id) for user_id in self._activity.newest()]
+
+    def users_page(self, cursor=None, limit=10):
+        """Страница пользователей по последней активности: (пользователи, курсор дальше, курсор назад)
+
+        Курсор назад -1 означает первую страницу.
+        """
+        user_ids, next_cursor, prev_cursor = self._activity.page(cursor, limit)
+        return [self._user_info(user_id) for user_id in user_ids], next_cursor, prev_cursor
+
+    def counts(self):
+        """Возвращает (новых, всего) по всем пользователям"""
+        raise NotImplementedError
+
+    # Срок хранения
+
+    def expired(self, max_age=None, max_per_user=None, max_total=None, now=None):
+        """Сколько самых старых сообщений каждого пользователя выходит за сроки хранения
+
+        max_age - в секундах; max_total применяется к тому, что осталось после
+        первых двух ограничений, и убирает самые старые сообщения по всем
+        пользователям. Возвращает {user_id: число}.
+        """
+        raise NotImplementedError
+
+    def oldest_messages(self, user_id, count):
+        """count самых старых сообщений пользователя (для архивации)"""
+        raise NotImplementedError
+
+    def drop_oldest(self, user_id, count):
+        """Удаляет count самых старых сообщений пользователя; возвращает Future записи на диск"""
+        raise NotImplementedError
+
+    def export(self):
+        """Возвращает все сообщения в формате stored_messages.json"""
+        raise NotImplementedError
+
+    def pending_writes(self):
+        """Количество изменений, еще не записанных на диск"""
+        return 0
+
+    def flush(self):
+        """Блокирует до записи на диск всех изменений"""
+
+    def close(self):
+        """Закрывает хранилище"""
+        self.flush()
+
+
+class JournalMessageStore(MessageStore):
+    """Хранилище сообщений в памяти с журналом только на дозапись (JSON lines)
+
+    Изменения применяются к памяти сразу в цикле событий, а в журнал пишутся
+    фоновым потоком. Каждая запись получает номер seq, поэтому при сжатии
+    журнала записи, уже попавшие в снимок, при проигрывании пропускаются.
+    В памяти сообщения лежат по столбцам (UserMessages), в журнале и при
+    экспорте - в прежнем формате словарей.
+
+    Снимок для сжатия берется копированием при записи: под замком копируется
+    только словарь ссылок, а пользователь, которого меняют во время записи
+    снимка, сначала получает собственную копию сообщений (_shared).
+    """
+
+    def __init__(self, path, legacy_path=None, compact_min=1000, compact_ratio=2, **writer_options):
+        self.path = path
+        self.compact_min = compact_min
+        self.compact_ratio = compact_ratio
+        self._messages = {}
+        self._counters = MessageCounters()
+        self._activity = ActivityIndex()
+        self._records = 0
+        self._seq = 0
+        self._snapshot_seq = 0
+        # _state_lock защищает данные в памяти, _file_lock - файл журнала
+        self._state_lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._compacting = False
+        self._shared = set()  # пользователи, чьи UserMessages сейчас читает снимок
+
+        if os.path.exists(path):
+            self._replay()
+        elif legacy_path and os.path.exists(legacy_path):
+            self._migrate(legacy_path)
+        self._rebuild_indexes()
+
+        self._journal = open(path, 'ab')
+        self._writer = BackgroundWriter(
+            self._write_records, sync=self._sync_journal, name='journal-writer', **writer_options
+        )
+
+    # Загрузка
+
+    def _replay(self):
+        """Восстанавливает состояние, проигрывая журнал"""
+        with open(self.path, 'rb') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Пропущена поврежденная запись журнала {self.path} (строка {line_no})")
+                    continue
+                self._apply(record)
+                self._records += 1
+
+            # Недописанная последняя строка (падение во время записи) не должна склеиться со следующей
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    with open(self.path, 'ab') as out:
+                        out.write(b'\n')
+
+        logger.info(f"Журнал сообщений загружен: {self._records} записей")
+
+    def _migrate(self, legacy_path):
+        """Одноразовый импорт старого stored_messages.json"""
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка импорта {legacy_path}: {e}")
+            return
+
+        for user_id, messages in data.items():
+            user_messages = self._messages.setdefault(str(user_id), UserMessages())
+            for msg in messages:
+                user_messages.append(msg)
+        self._records = self._write_snapshot(self.path, self._messages)
+        logger.info(f"Импортировано {self._records - 1} сообщений из {legacy_path} в журнал {self.path}")
+
+    def _rebuild_indexes(self):
+        """Один полный проход при загрузке; дальше счетчики и индекс активности обновляются по ходу"""
+        self._counters = MessageCounters()
+        self._activity = ActivityIndex()
+        for user_id, messages in self._messages.items():
+            if messages:
+                self._counters.load_user(user_id, len(messages), messages.unread())
+        by_activity = sorted(
+            (user_id for user_id, messages in self._messages.items() if messages),
+            key=lambda user_id: self._messages[user_id].last_timestamp()
+        )
+        for user_id in by_activity:
+            self._activity.touch(user_id)
+
+    def _apply(self, record):
+        """Применяет одну запись журнала к состоянию в памяти"""
+        op = record.get('op')
+        seq = record.get('seq', 0)
+        if op == 'snapshot':
+            self._snapshot_seq = seq
+            self._seq = max(self._seq, seq)
+            return
+        if seq and seq <= self._snapshot_seq:
+            return
+        self._seq = max(self._seq, seq)
+
+        user_id = record.get('user_id')
+        if op == 'add':
+            self._messages.setdefault(user_id, UserMessages()).append(record['message'])
+        elif op == 'viewed' and user_id in self._messages:
+            self._messages[user_id].mark_viewed()
+        elif op == 'drop' and user_id in self._messages:
+            messages = self._messages[user_id]
+            messages.drop(min(record['count'], len(messages)))
+            if not messages:
+                del self._messages[user_id]
+
+    # Запись
+
+    def _mutable(self, user_id):
+        """Сообщения пользователя, которые можно менять; вызывается под _state_lock"""
+        messages = self._messages.get(user_id)
+        if messages is not None and user_id in self._shared:
+            messages = self._messages[user_id] = messages.copy()
+            self._shared.discard(user_id)
+        return messages
+
+    def _next_record(self, op, user_id, **fields):
+        """Создает запись журнала; вызывается под _state_lock"""
+        self._seq += 1
+        return {'seq': self._seq, 'op': op, 'user_id': user_id, **fields}
+
+    def _write_records(self, records):
+        """Дописывает записи в журнал (поток записи)"""
+        data = b''.join(_encode(record) for record in records)
+        with self._file_lock:
+            self._journal.write(data)
+            self._journal.flush()
+            self._records += len(records)
+        self._maybe_compact()
+
+    def _sync_journal(self):
+        with self._file_lock:
+            os.fsync(self._journal.fileno())
+
+    def add_message(self, user_id, message):
+        user_id = str(user_id)
+        message = dict(message)
+        with self._state_lock:
+            messages = self._mutable(user_id)
+            if messages is None:
+                messages = self._messages[user_id] = UserMessages()
+            messages.append(message)
+            self._counters.added(user_id, message.get('viewed', False))
+            self._activity.touch(user_id)
+            record = self._next_record('add', user_id, message=message)
+        return self._writer.submit(record)
+
+    def mark_viewed(self, user_id):
+        user_id = str(user_id)
+        with self._state_lock:
+            if not self._counters.viewed(user_id):
+                return _done_future()
+            self._mutable(user_id).mark_viewed()
+            record = self._next_record('viewed', user_id)
+        return self._writer.submit(record)
+
+    # Чтение
+
+    def get_user_messages(self, user_id):
+        messages = self._messages.get(str(user_id))
+        return list(messages) if messages else []
+
+    def user_messages_page(self, user_id, offset, limit):
+        messages = self._messages.get(str(user_id))
+        if not messages:
+            return [], 0
+        return messages.slice(offset, offset + limit), len(messages)
+
+    def _user_info(self, user_id):
+        messages = self._messages[user_id]
+        total, unread = self._counters.user(user_id)
+        return {
+            'user_id': user_id,
+            'full_name': messages.full_name or 'Неизвестный',
+            'username': messages.username or 'без @username',
+            'total': total,
+            'unread': unread,
+        }
+
+    def counts(self):
+        return self._counters.unread, self._counters.total
+
+    def export(self):
+        return {user_id: list(msgs) for user_id, msgs in self._messages.items()}
+
+    # Срок хранения
+
+    def expired(self, max_age=None, max_per_user=None, max_total=None, now=None):
+        with self._state_lock:
+            timestamps = {user_id: messages.timestamps for user_id, messages in self._messages.items()}
+            return plan_expired(timestamps, max_age, max_per_user, max_total, now)
+
+    def oldest_messages(self, user_id, count):
+        with self._state_lock:
+            messages = self._messages.get(str(user_id))
+            return messages.slice(0, count) if messages else []
+
+    def drop_oldest(self, user_id, count):
+        user_id = str(user_id)
+        with self._state_lock:
+            if not self._messages.get(user_id) or count <= 0:
+                return _done_future()
+            messages = self._mutable(user_id)
+            count = min(count, len(messages))
+            self._counters.removed(user_id, count, messages.drop(count))
+            if not messages:
+                del self._messages[user_id]
+                self._activity.remove(user_id)
+            record = self._next_record('drop', user_id, count=count)
+        return self._writer.submit(record)
+
+    # Сжатие журнала
+
+    @staticmethod
+    def _write_snapshot(path, messages, seq=0):
+        """Пишет журнал, содержащий только актуальное состояние на момент записи seq"""
+        count = 1
+        with open(path, 'wb') as f:
+            f.write(_encode({'op': 'snapshot', 'seq': seq}))
+            for user_id, msgs in messages.items():
+                for msg in msgs:
+                    f.write(_encode({'op': 'add', 'user_id': user_id, 'message': msg}))
+                    count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        return count
+
+    def _maybe_compact(self):
+        if self._compacting or self._records < self.compact_min:
+            return
+        if self._records < self.compact_ratio * max(self._counters.total, 1):
+            return
+        self._compacting = True
+        threading.Thread(target=self._compact, name='journal-compact', daemon=True).start()
+
+    def _compact(self):
+        """Переписывает журнал в фоне; записи после снимка переносятся в конец как есть"""
+        tmp_path = self.path + '.tmp'
+        try:
+            # Все, что в файле до offset, уже есть в памяти, а значит и в снимке.
+            # Записи между offset и снимком попадут в хвост, но будут пропущены по seq.
+            with self._file_lock:
+                self._journal.flush()
+                offset = self._journal.tell()
+            # Под замком копируются только ссылки: измененный во время записи пользователь
+            # получит свою копию в _mutable(), а снимок останется неизменным
+            with self._state_lock:
+                snapshot_seq = self._seq
+                snapshot = dict(self._messages)
+                self._shared = set(snapshot)
+
+            try:
+                written = self._write_snapshot(tmp_path, snapshot, snapshot_seq)
+            finally:
+                with self._state_lock:
+                    self._shared = set()
+
+            with self._file_lock:
+                self._journal.flush()
+                with open(self.path, 'rb') as src:
+                    src.seek(offset)
+                    tail = src.read()
+                with open(tmp_path, 'ab') as dst:
+                    dst.write(tail)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                self._journal.close()
+                os.replace(tmp_path, self.path)
+                self._journal = open(self.path, 'ab')
+                before = self._records
+                self._records = written + tail.count(b'\n')
+
+            logger.info(f"Журнал {self.path} сжат: {before} -> {self._records} записей")
+        except Exception as e:
+            logger.error(f"Ошибка сжатия журнала {self.path}: {e}")
+        finally:
+            self._compacting = False
+
+    def pending_writes(self):
+        return self._writer.pending()
+
+    def flush(self):
+        self._writer.flush()
+        with self._file_lock:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def close(self):
+        self._writer.close()
+        with self._file_lock:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal.close()
+
+
+class SQLiteMessageStore(MessageStore):
+    """Хранилище сообщений в SQLite (WAL) с индексами под запросы админки
+
+    Счетчики держатся в памяти и меняются сразу, запись в базу идет потоком
+    записи. Сколько новых среди удаляемых сообщений, точно известно только в
+    транзакции удаления: drop_oldest() сразу вычитает оценку (новые - конец
+    списка), а поток записи досчитывает разницу, если с тех пор пользователь
+    не открывал сообщения и не был удален целиком (номер _view_epochs).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            type TEXT NOT NULL DEFAULT 'text',
+            content TEXT,
+            full_name TEXT,
+            username TEXT,
+            viewed INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(user_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_messages_unread ON messages(user_id) WHERE viewed = 0;
+        CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(timestamp);
+    """
+    COLUMNS = "timestamp, type, content, full_name, username, viewed"
+    _INSERT = f"INSERT INTO messages (user_id, {COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, path, legacy_path=None, **writer_options):
+        self.path = path
+        self._lock = threading.Lock()
+        # Счетчики меняют и цикл событий, и поток записи (поправки после удаления)
+        self._counters_lock = threading.Lock()
+        self._view_epochs = {}
+        # Пишет только поток записи через _write_db, читает цикл событий через _db: в WAL они не мешают друг другу
+        self._write_db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._write_db.execute("PRAGMA journal_mode=WAL")
+        # В WAL режим FULL синхронизирует каждую транзакцию (группу), NORMAL - только контрольные точки
+        fsync = writer_options.get('fsync', 'batch')
+        self._write_db.execute(f"PRAGMA synchronous={'FULL' if fsync == 'batch' else 'NORMAL'}")
+        self._write_db.executescript(self.SCHEMA)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+        empty = self._db.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None
+        if empty and legacy_path and os.path.exists(legacy_path):
+            self._migrate(legacy_path)
+        self._load_counters()
+
+        self._writer = BackgroundWriter(self._write_records, name='sqlite-writer', **writer_options)
+
+    def _migrate(self, legacy_path):
+        """Одноразовый импорт старого stored_messages.json"""
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка импорта {legacy_path}: {e}")
+            return
+
+        rows = [self._row(user_id, msg) for user_id, msgs in data.items() for msg in msgs]
+        self._write_db.execute("BEGIN")
+        self._write_db.executemany(self._INSERT, rows)
+        self._write_db.execute("COMMIT")
+        logger.info(f"Импортировано {len(rows)} сообщений из {legacy_path} в {self.path}")
+
+    @staticmethod
+    def _row(user_id, message):
+        return (
+            str(user_id),
+            str(message.get('timestamp', '')),
+            message.get('type', 'text'),
+            message.get('content'),
+            message.get('full_name'),
+            message.get('username'),
+            1 if message.get('viewed', False) else 0,
+        )
+
+    @staticmethod
+    def _message(row):
+        timestamp, msg_type, content, full_name, username, viewed = row
+        return {
+            'timestamp': timestamp,
+            'type': msg_type,
+            'content': content,
+            'full_name': full_name,
+            'username': username,
+            'viewed': bool(viewed),
+        }
+
+    def _load_counters(self):
+        """Счетчики и имена пользователей держатся в памяти: один запрос при открытии"""
+        self._counters = MessageCounters()
+        self._activity = ActivityIndex()
+        self._users = {}
+        rows = self._db.execute(
+            "SELECT t.user_id, m.full_name, m.username, t.total, t.unread "
+            "FROM (SELECT user_id, MIN(id) AS first_id, COUNT(*) AS total, SUM(viewed = 0) AS unread, "
+            "             MAX(timestamp) AS last_ts "
+            "      FROM messages GROUP BY user_id) t "
+            "JOIN messages m ON m.id = t.first_id "
+            "ORDER BY t.last_ts"
+        ).fetchall()
+        for user_id, full_name, username, total, unread in rows:
+            self._users[user_id] = (full_name, username)
+            self._counters.load_user(user_id, total, unread)
+            self._activity.touch(user_id)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _write_records(self, records):
+        """Применяет изменения одной транзакцией (поток записи)"""
+        corrections = []
+        self._write_db.execute("BEGIN")
+        try:
+            for op, args in records:
+                if op == 'add':
+                    self._write_db.execute(self._INSERT, args)
+                elif op == 'viewed':
+                    self._write_db.execute(
+                        "UPDATE messages SET viewed = 1 WHERE user_id = ? AND viewed = 0", args
+                    )
+                elif op == 'drop':
+                    user_id, count, epoch, estimate = args
+                    if epoch is not None:
+                        # Все изменения до этого удаления уже в транзакции - число новых точное
+                        unread = self._write_db.execute(
+                            "SELECT COUNT(*) FROM (SELECT viewed FROM messages WHERE user_id = ? "
+                            "ORDER BY timestamp, id LIMIT ?) WHERE viewed = 0",
+                            (user_id, count)
+                        ).fetchone()[0]
+                        if unread != estimate:
+                            corrections.append((user_id, epoch, unread - estimate))
+                    self._write_db.execute(
+                        "DELETE FROM messages WHERE id IN "
+                        "(SELECT id FROM messages WHERE user_id = ? ORDER BY timestamp, id LIMIT ?)",
+                        (user_id, count)
+                    )
+            self._write_db.execute("COMMIT")
+        except Exception:
+            self._write_db.execute("ROLLBACK")
+            raise
+        with self._counters_lock:
+            for user_id, epoch, unread in corrections:
+                # Если пользователь с тех пор открыл сообщения или удален, счетчик уже сброшен
+                if self._view_epochs.get(user_id, 0) == epoch:
+                    self._counters.removed(user_id, 0, unread)
+
+    def add_message(self, user_id, message):
+        row = self._row(user_id, message)
+        user_id = row[0]
+        self._users.setdefault(user_id, (row[4], row[5]))
+        with self._counters_lock:
+            self._counters.added(user_id, row[6])
+        self._activity.touch(user_id)
+        return self._writer.submit(('add', row))
+
+    def mark_viewed(self, user_id):
+        user_id = str(user_id)
+        with self._counters_lock:
+            if not self._counters.viewed(user_id):
+                return _done_future()
+            self._view_epochs[user_id] = self._view_epochs.get(user_id, 0) + 1
+        return self._writer.submit(('viewed', (user_id,)))
+
+    def get_user_messages(self, user_id):
+        rows = self._query(
+            f"SELECT {self.COLUMNS} FROM messages WHERE user_id = ? ORDER BY timestamp, id", (str(user_id),)
+        )
+        return [self._message(row) for row in rows]
+
+    def user_messages_page(self, user_id, offset, limit):
+        rows = self._query(
+            f"SELECT {self.COLUMNS} FROM messages WHERE user_id = ? ORDER BY timestamp, id LIMIT ? OFFSET ?",
+            (str(user_id), limit, offset)
+        )
+        total, _ = self._counters.user(str(user_id))
+        return [self._message(row) for row in rows], total
+
+    def _user_info(self, user_id):
+        full_name, username = self._users[user_id]
+        total, unread = self._counters.user(user_id)
+        return {
+            'user_id': user_id,
+            'full_name': full_name or 'Неизвестный',
+            'username': username or 'без @username',
+            'total': total,
+            'unread': unread,
+        }
+
+    def counts(self):
+        return self._counters.unread, self._counters.total
+
+    def export(self):
+        data = {}
+        for row in self._query(f"SELECT user_id, {self.COLUMNS} FROM messages ORDER BY user_id, timestamp, id"):
+            data.setdefault(row[0], []).append(self._message(row[1:]))
+        return data
+
+    # Срок хранения
+
+    def expired(self, max_age=None, max_per_user=None, max_total=None, now=None):
+        drops = {}
+        if max_age:
+            rows = self._query(
+                "SELECT user_id, COUNT(*) FROM messages WHERE timestamp < ? GROUP BY user_id",
+                (_cutoff(max_age, now).isoformat(),)
+            )
+            drops.update(rows)
+        if max_per_user:
+            for user_id in list(self._counters.users()):
+                total, _ = self._counters.user(user_id)
+                if total > max_per_user:
+                    drops[user_id] = max(drops.get(user_id, 0), total - max_per_user)
+
+        excess = self._counters.total - sum(drops.values()) - max_total if max_total else 0
+        if excess > 0:
+            # Проход по всем сообщениям от старых к новым (индекс по времени);
+            # уже выбранные выше префиксы пользователей пропускаются
+            planned = dict(drops)
+            seen = {}
+            with self._lock:
+                for (user_id,) in self._db.execute("SELECT user_id FROM messages ORDER BY timestamp, id"):
+                    seen[user_id] = seen.get(user_id, 0) + 1
+                    if seen[user_id] <= planned.get(user_id, 0):
+                        continue
+                    drops[user_id] = drops.get(user_id, 0) + 1
+                    excess -= 1
+                    if excess <= 0:
+                        break
+        return drops
+
+    def oldest_messages(self, user_id, count):
+        rows = self._query(
+            f"SELECT {self.COLUMNS} FROM messages WHERE user_id = ? ORDER BY timestamp, id LIMIT ?",
+            (str(user_id), count)
+        )
+        return [self._message(row) for row in rows]
+
+    def drop_oldest(self, user_id, count):
+        user_id = str(user_id)
+        with self._counters_lock:
+            total, unread = self._counters.user(user_id)
+            count = min(count, total)
+            if count <= 0:
+                return _done_future()
+            if count == total:
+                # Удаляются все сообщения - новые среди них все, поправка не нужна
+                self._counters.removed(user_id, count, unread)
+                self._view_epochs[user_id] = self._view_epochs.get(user_id, 0) + 1
+                epoch = estimate = None
+            else:
+                # Новые сообщения появляются в конце, а просмотр отмечает сразу все
+                estimate = max(0, unread - (total - count))
+                self._counters.removed(user_id, count, estimate)
+                epoch = self._view_epochs.get(user_id, 0)
+        if count == total:
+            self._users.pop(user_id, None)
+            self._activity.remove(user_id)
+        return self._writer.submit(('drop', (user_id, count, epoch, estimate)))
+
+    def pending_writes(self):
+        return self._writer.pending()
+
+    def flush(self):
+        self._writer.flush()
+        with self._lock:
+            self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        with self._lock:
+            self._db.close()
+        self._write_db.close()
+
+
+def open_message_store(backend, path, legacy_path=None, **writer_options):
+    """Создает хранилище сообщений выбранного типа; writer_options передаются в BackgroundWriter"""
+    if backend == 'journal':
+        return JournalMessageStore(path, legacy_path=legacy_path, **writer_options)
+    if backend == 'sqlite':
+        return SQLiteMessageStore(path, legacy_path=legacy_path, **writer_options)
+    raise ValueError(f"Неизвестный тип хранилища: {backend}")
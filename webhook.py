@@ -0,0 +1,153 @@
+import asyncio
+import hmac
+import json
+import logging
+import ssl
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Telegram присылает обновления размером в килобайты; больше - явно не от него
+MAX_BODY_SIZE = 1024 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    503: 'Service Unavailable',
+}
+
+
+def make_ssl_context(cert, key):
+    """TLS-контекст сервера из файлов сертификата и ключа"""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+class WebhookServer:
+    """Встроенный HTTP-сервер для вебхука Telegram на asyncio
+
+    Принимает POST с JSON-обновлением на url_path, проверяет заголовок
+    X-Telegram-Bot-Api-Secret-Token и кладет Update прямо в очередь
+    Application - дальше он обрабатывается так же, как при run_polling
+    (с тем же concurrent_updates). Соединения держатся открытыми
+    (keep-alive), как это делает Telegram. Ответ 200 отправляется сразу
+    после постановки в очередь: обработка не задерживает Telegram.
+    """
+
+    def __init__(self, application, listen='127.0.0.1', port=8443, url_path='/',
+                 secret_token=None, ssl_context=None, max_body=MAX_BODY_SIZE):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.url_path = '/' + url_path.lstrip('/')
+        self.secret_token = secret_token
+        self.ssl_context = ssl_context
+        self.max_body = max_body
+        self.received = 0
+        self.rejected = 0
+        self._server = None
+        self._connections = {}  # writer -> задача соединения
+
+    @property
+    def bound_port(self):
+        """Фактический порт (при port=0 его выбирает система)"""
+        return self._server.sockets[0].getsockname()[1] if self._server else None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._serve, self.listen, self.port, ssl=self.ssl_context, limit=MAX_HEADER_SIZE
+        )
+        logger.info(f"Вебхук слушает {self.listen}:{self.bound_port}{self.url_path}")
+
+    async def stop(self):
+        if not self._server:
+            return
+        self._server.close()
+        # Закрытие сокета будит ожидающие чтения: обработчики завершаются сами
+        tasks = list(self._connections.values())
+        for writer in list(self._connections):
+            writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _serve(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                status, keep_alive = await self._handle(head, reader)
+                await self._respond(writer, status, keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            # Тело короче Content-Length или клиент оборвал соединение - отвечать некому
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _handle(self, head, reader):
+        """Разбирает запрос и возвращает (код ответа, держать ли соединение)"""
+        try:
+            request_line, *header_lines = head.decode('latin-1').split('\r\n')
+            method, target, version = request_line.split(' ', 2)
+        except ValueError:
+            return 400, False
+        headers = {}
+        for line in header_lines:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return 400, False
+        if length > self.max_body:
+            return 413, False
+        body = await reader.readexactly(length) if length else b''
+
+        path = target.split('?', 1)[0]
+        if path != self.url_path:
+            return 404, keep_alive
+        if method != 'POST':
+            return 405, keep_alive
+        if self.secret_token is not None:
+            token = headers.get('x-telegram-bot-api-secret-token', '')
+            if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+                self.rejected += 1
+                logger.warning("Вебхук: запрос с неверным секретным токеном")
+                return 403, keep_alive
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Вебхук: не удалось разобрать обновление: {e}")
+            return 400, keep_alive
+        if not self.application.running:
+            return 503, keep_alive
+
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return 200, keep_alive
+
+    @staticmethod
+    async def _respond(writer, status, keep_alive):
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            "Content-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+        )
+        await writer.drain()